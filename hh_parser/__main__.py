@@ -1,9 +1,14 @@
 import argparse
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
 
+from .lib.conn_pool import email_conn_pool
 from .lib.main_processor import MainProcessor
-from .lib.service_funcs import exception_notify, remove_old_files, set_logging, read_yml_config
+from .lib.service_funcs import exception_notify, remove_old_files, set_logging, read_yml_config, \
+    send_pending_notifications
 
 log = logging.getLogger(__name__)
 
@@ -15,38 +20,60 @@ CONFIGS_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), 'config
 LOGS_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), 'logs'))
 
 
+def _process_config(config_file: str, args: argparse.Namespace, logs_file_path: Optional[str],
+                    pending_notifications: list) -> None:
+    """
+    Запусти сервис для одного файла конфигурации.
+    :param config_file: Имя файла конфигурации
+    :param args: Параметры, с которыми запущено приложение
+    :param logs_file_path: Путь к файлу с логами
+    :param pending_notifications: Очередь оповещений об ошибках
+    """
+    try:
+        config_path = os.path.join(CONFIGS_FOLDER, config_file)
+        config = read_yml_config(file_path=config_path)
+        service_email_params = {
+            'smtp_host': config.service_mail.server,
+            'smtp_port': config.service_mail.port,
+            'smtp_login': config.service_mail.login,
+            'smtp_password': config.service_mail.password,
+            'smtp_use_ssl': config.service_mail.ssl,
+            'email_to': config.service_mail.email_to,
+            'email_from': config.service_mail.email_from,
+            'log_file_path': logs_file_path,
+            'pending_notifications': pending_notifications,
+        }
+    except FileNotFoundError:
+        log.warning(f'Configuration file not found: {config_file}')
+        return
+
+    @exception_notify(**service_email_params)
+    def run(cfg, arguments):
+        worker = MainProcessor(cfg, arguments)
+        worker.run()
+        worker.stop()
+
+    run(config, args)
+
+
 def main():
     logs_file_path = set_logging(logs_folder=LOGS_FOLDER)
     args = parser.parse_args()
 
     config_files = list(set(args.cfg_filename)) if args.cfg_filename \
         else list(filter(lambda x: x.endswith('.yml') and x != 'cfg_example.yml', os.listdir(CONFIGS_FOLDER)))
-    for config_file in config_files:
-        try:
-            config_path = os.path.join(CONFIGS_FOLDER, config_file)
-            config = read_yml_config(file_path=config_path)
-            service_email_params = {
-                'smtp_host': config.service_mail.server,
-                'smtp_port': config.service_mail.port,
-                'smtp_login': config.service_mail.login,
-                'smtp_password': config.service_mail.password,
-                'smtp_use_ssl': config.service_mail.ssl,
-                'email_to': config.service_mail.email_to,
-                'email_from': config.service_mail.email_from,
-                'log_file_path': logs_file_path,
-            }
-        except FileNotFoundError:
-            log.warning(f'Configuration file not found: {config_file}')
-            continue
-
-        @exception_notify(**service_email_params)
-        def run(cfg, arguments):
-            worker = MainProcessor(cfg, arguments)
-            worker.run()
-            worker.stop()
-
-        run(config, args)
+    pending_notifications = []
+    try:
+        # Конфигурации независимы и упираются в сеть, поэтому обрабатываются параллельно
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(config_files)))) as executor:
+            list(executor.map(partial(_process_config, args=args, logs_file_path=logs_file_path,
+                                      pending_notifications=pending_notifications), config_files))
+    finally:
+        # Оповещения об ошибках отправляются одной SMTP-сессией после обработки всех конфигураций
+        send_pending_notifications(pending_notifications)
 
+    # Подключения к почтовым серверам переиспользуются всеми конфигурациями и закрываются здесь
+    email_conn_pool.close_all()
     remove_old_files(folder_path=LOGS_FOLDER, lifetime_days=180, file_type='.log')
 
 
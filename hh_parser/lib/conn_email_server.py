@@ -1,26 +1,104 @@
-import base64
+import binascii
 import email
 import imaplib
+import io
 import logging
 import mimetypes
 import os
-import quopri
 import re
 import smtplib
+import ssl
+import stat
+import weakref
 import zipfile
+from abc import ABC, abstractmethod
 from datetime import datetime
-from email import encoders
-from email.mime.audio import MIMEAudio
+from email.header import decode_header, make_header
 from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Optional, Union, List, NamedTuple, Iterator
+from typing import Optional, Union, List, NamedTuple, Iterator, BinaryIO, Dict, Tuple
 
-log = logging.getLogger(__name__)
+from .conn_pool import email_conn_pool
+
+try:
+    # SIMD-реализация base64, заметно быстрее stdlib на больших письмах
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
 
+log = logging.getLogger(__name__)
 
-class ConnEmailServer:
+# База mime-типов загружается при импорте, а не при первой отправке письма
+mimetypes.init()
+
+# Общий TLS-контекст: корневые сертификаты загружаются один раз, а не при каждом подключении.
+# Сессии TLS при переподключениях не возобновляются: imaplib и smtplib не передают session в wrap_socket
+_SSL_CTX = ssl.create_default_context()
+_FETCH_UID_RE = re.compile(rb'UID (\d+)')
+# Адрес без пробелов по краям
+_EMAIL_ADDR_PATTERN = r'[^@\s<>]+@[^@\s<>.]+(?:\.[^@\s<>.]+)+'
+# Адрес целиком: "адрес", "<адрес>" или "Имя <адрес>". Классы символов соседних частей не пересекаются
+# (имя не начинается с пробела, метки домена не содержат точек), поэтому перебор линейный
+_EMAIL_RE = re.compile(rf'(?:(?:[^<>\s][^<>]*)?<{_EMAIL_ADDR_PATTERN}>|{_EMAIL_ADDR_PATTERN})')
+_HTML_TAG_RE = re.compile(rb'<[^>]*>')
+_B64_RE = re.compile(rb'^[A-Za-z0-9+/=\s]+$')
+_QP_RE = re.compile(rb'=[0-9A-Fa-f]{2}')
+# Значение заголовка вместе со строками-продолжениями (folding)
+_SUBJECT_HEADER_RE = re.compile(rb'(?im)^subject:[ \t]*(.*(?:\r?\n[ \t].*)*)')
+_CTE_HEADER_RE = re.compile(rb'(?im)^content-transfer-encoding:[ \t]*(.*(?:\r?\n[ \t].*)*)')
+_RECEIVED_HEADER_RE = re.compile(rb'(?im)^received:[ \t]*(.*(?:\r?\n[ \t].*)*)')
+_FOLDING_RE = re.compile(rb'\r?\n')
+_MONTHS = {m: i for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1
+)}
+# Уже сжатые форматы: повторное сжатие тратит CPU и почти не уменьшает размер
+_PRECOMPRESSED = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.avi', '.mov', '.pdf', '.docx',
+                            '.xlsx', '.pptx', '.zip', '.gz', '.xz', '.7z'})
+_PRECOMPRESSED_MAINTYPES = frozenset({'image', 'video', 'audio'})
+# Папка, выбранная в каждом IMAP-подключении пула
+_SELECTED_FOLDERS: 'weakref.WeakKeyDictionary[imaplib.IMAP4, str]' = weakref.WeakKeyDictionary()
+# UIDVALIDITY папок из ответов SELECT для каждого IMAP-подключения пула
+_FOLDERS_UIDVALIDITY: 'weakref.WeakKeyDictionary[imaplib.IMAP4, Dict[str, str]]' = weakref.WeakKeyDictionary()
+
+
+def _encode_file_base64(fp: BinaryIO) -> str:
+    """
+    Закодируй файл в base64 по частям, не читая его в память целиком.
+    :param fp: Файл, открытый в бинарном режиме
+    :return: Base64 с переносами строк по RFC 2045
+    """
+    encoded = io.BytesIO()
+    # 57 байт дают ровно одну строку base64 длиной 76 символов
+    for chunk in iter(lambda: fp.read(57 * 1024), b''):
+        encoded.write(_b64.encodebytes(chunk))
+    return encoded.getvalue().decode('ascii')
+
+
+def _quote_imap(value: str) -> str:
+    """
+    Оберни строку в кавычки по правилам quoted string из RFC 3501.
+    :param value: Строка для передачи в команду IMAP
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _get_header(raw_header: bytes, header_re: re.Pattern) -> Optional[str]:
+    """
+    Найди значение заголовка в сырых заголовках письма без построения email.message.
+    :param raw_header: Заголовки письма
+    :param header_re: Регулярное выражение заголовка
+    :return: Значение первого найденного заголовка или None
+    """
+    match = header_re.search(raw_header)
+    if not match:
+        return
+    value = _FOLDING_RE.sub(b'', match.group(1)).strip().decode('utf-8', errors='replace')
+    # Заголовки в кодировке RFC 2047: =?UTF-8?B?...?=
+    return str(make_header(decode_header(value))) if '=?' in value else value
+
+
+class ConnEmailServer(ABC):
     """Подключение к почтовому серверу."""
 
     def __init__(self, host: str, port: int, login: str, password: str, use_ssl: bool) -> None:
@@ -29,46 +107,95 @@ class ConnEmailServer:
         self.__login = login
         self.__password = password
         self.__use_ssl = use_ssl
-        self.__imap_client = None
-        self.__smtp_client = None
 
     host = property(lambda self: self.__host)
     port = property(lambda self: self.__port)
     login = property(lambda self: self.__login)
-    password = property(lambda self: base64.b64encode(self.__password.encode('utf-8')))
+    password = property(lambda self: self.__password)
     use_ssl = property(lambda self: self.__use_ssl)
 
+    def __enter__(self) -> 'ConnEmailServer':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.disconnect()
+
+    @abstractmethod
+    def connect(self) -> None:
+        """Подключись к почтовому серверу."""
+
+    @abstractmethod
+    def disconnect(self) -> None:
+        """Отключись от сервера."""
+
 
 class ConnImapEmailServer(ConnEmailServer):
     """Подключение к почтовому серверу по IMAP."""
 
     def __init__(self, host: str,  login: str, password: str, port: int = 993, use_ssl: bool = True) -> None:
         super().__init__(host, port, login, password, use_ssl)
+        self.__imap_client = None
         self.connect()
 
     def _create_imap_client(self) -> None:
         """Создай клиент подключения к почтовому серверу."""
         log.debug(f'Connecting to {self.host}:{self.port} via IMAP{" using SSL" if self.use_ssl else ""}...')
-        self.__imap_client = imaplib.IMAP4_SSL(self.host, self.port) if self.use_ssl else \
+        self.__imap_client = imaplib.IMAP4_SSL(self.host, self.port, ssl_context=_SSL_CTX) if self.use_ssl else \
             imaplib.IMAP4(self.host, self.port)
         log.debug('Connected via IMAP')
 
     def _authenticate(self) -> None:
         """Аутентифицируйся на сервере."""
         log.debug(f'Authenticating with login "{self.login}"...')
-        self.__imap_client.login(self.login, base64.b64decode(self.password).decode('utf-8'))
+        self.__imap_client.login(self.login, self.password)
         log.debug('Authenticating success')
 
-    def connect(self):
-        """Подключись к почтовому серверу."""
+    def _open_imap_client(self) -> imaplib.IMAP4:
+        """Создай авторизованный клиент подключения к почтовому серверу."""
         self._create_imap_client()
         self._authenticate()
+        return self.__imap_client
+
+    def connect(self) -> None:
+        """Подключись к почтовому серверу."""
+        self.__imap_client = email_conn_pool.get_or_create(
+            key=('imap', self.host, self.port, self.login),
+            create=self._open_imap_client,
+            close=lambda client: client.logout()
+        )
 
     def disconnect(self) -> None:
-        """Отключись от сервера."""
-        log.debug(f'Disconnecting from {self.host}:{self.port}...')
-        self.__imap_client.logout()
-        log.debug('Disconnected')
+        """Верни подключение в пул. Подключение закрывается при завершении процесса."""
+        if self.__imap_client is None:
+            return
+        log.debug(f'Releasing connection to {self.host}:{self.port}')
+        self.__imap_client = None
+
+    def _select_folder(self, folder: str) -> None:
+        """
+        Выбери папку почтового ящика, если она еще не выбрана в этом подключении.
+        :param folder: Папка почтового ящика
+        """
+        # Подключение из пула переживает экземпляр класса, поэтому выбранную папку запоминаем для самого подключения
+        if _SELECTED_FOLDERS.get(self.__imap_client) == folder:
+            return
+        result_select, _ = self.__imap_client.select(folder)
+        if result_select == 'OK':
+            _SELECTED_FOLDERS[self.__imap_client] = folder
+            _, uidvalidity = self.__imap_client.response('UIDVALIDITY')
+            if uidvalidity and uidvalidity[0]:
+                _FOLDERS_UIDVALIDITY.setdefault(self.__imap_client, {})[folder] = uidvalidity[0].decode('utf-8')
+        else:
+            _SELECTED_FOLDERS.pop(self.__imap_client, None)
+
+    def get_folder_uidvalidity(self, folder: str = 'INBOX') -> Optional[str]:
+        """
+        Получи UIDVALIDITY папки. Если значение изменилось, ранее полученные uid писем этой папки недействительны.
+        :param folder: Папка почтового ящика
+        :return: UIDVALIDITY или None, если сервер его не сообщил
+        """
+        self._select_folder(folder)
+        return _FOLDERS_UIDVALIDITY.get(self.__imap_client, {}).get(folder)
 
     def get_emails_uid_in_folder_by_subject(self, subject: str, folder: str = 'INBOX',
                                             use_strict_subject: bool = True) -> Optional[List[str]]:
@@ -80,10 +207,8 @@ class ConnImapEmailServer(ConnEmailServer):
         :return: Список найденных uid писем
         """
         log.debug(f'Looking for mails in folder "{folder}" by subject "{subject}"...')
-        self.__imap_client.select(folder)
-        email_subject_formated = '_'.join(subject.split())
-        result_search, raw_msg_uids = self.__imap_client.uid('search', None, 'SUBJECT', email_subject_formated)
-        msg_uids = raw_msg_uids[0].decode('utf-8').split()
+        self._select_folder(folder)
+        msg_uids = self._search_uids_by_subject(subject)
 
         if len(msg_uids) == 0:
             log.info(f'No mails found in folder "{folder}" by subject "{subject}"')
@@ -93,15 +218,52 @@ class ConnImapEmailServer(ConnEmailServer):
             log.info(f'Found {len(msg_uids)} mails in folder "{folder}" by subject "{subject}"')
             return msg_uids
 
-        strict_msg_uids = []
-        for uid in msg_uids:
-            result_fetch, raw_email_header = self.__imap_client.uid('fetch', uid, 'BODY.PEEK[HEADER]')
-            email_subject_by_uid = email.message_from_string(raw_email_header[0][1].decode('utf-8')).get('subject')
-            if email_subject_by_uid == subject:
-                strict_msg_uids.append(uid)
+        # Заголовки всех найденных писем запрашиваем одним FETCH
+        result_fetch, raw_email_headers = self.__imap_client.uid('fetch', ','.join(msg_uids),
+                                                                 '(BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+        strict_msg_uids = [
+            uid for uid, header in self._parse_fetch_response(raw_email_headers).items()
+            if _get_header(header, _SUBJECT_HEADER_RE) == subject
+        ]
         log.info(f'Found {len(strict_msg_uids)} mails in folder "{folder}" with strict match subject "{subject}"')
         return strict_msg_uids
 
+    @staticmethod
+    def _parse_fetch_response(raw_response: list) -> Dict[str, bytes]:
+        """
+        Разбери ответ UID FETCH.
+        :param raw_response: Ответ imaplib: кортежи (конверт, данные) вперемешку с разделителями b')'
+        :return: Словарь {uid: данные}
+        """
+        parsed_response = {}
+        for i, item in enumerate(raw_response):
+            if not isinstance(item, tuple):
+                continue
+            uid = _FETCH_UID_RE.search(item[0])
+            # Часть серверов присылает UID после литерала, в строке-разделителе: b' UID 42)'
+            if not uid and i + 1 < len(raw_response) and isinstance(raw_response[i + 1], bytes):
+                uid = _FETCH_UID_RE.search(raw_response[i + 1])
+            if uid:
+                parsed_response[uid.group(1).decode('utf-8')] = item[1]
+        return parsed_response
+
+    def _search_uids_by_subject(self, subject: str) -> List[str]:
+        """
+        Найди uid писем в выбранной папке по теме письма.
+        :param subject: Тема письма
+        """
+        # Тему передаем литералом в UTF-8, чтобы сервер искал по ней без искажений
+        self.__imap_client.literal = subject.encode('utf-8')
+        try:
+            result_search, raw_msg_uids = self.__imap_client.uid('search', 'CHARSET', 'UTF-8', 'SUBJECT')
+        except imaplib.IMAP4.error as e:
+            result_search, raw_msg_uids = 'BAD', [str(e).encode('utf-8')]
+        if result_search != 'OK':
+            log.debug(f'Server does not support SEARCH CHARSET UTF-8: {raw_msg_uids}')
+            self.__imap_client.literal = None
+            result_search, raw_msg_uids = self.__imap_client.uid('search', None, 'SUBJECT', _quote_imap(subject))
+        return raw_msg_uids[0].decode('utf-8').split()
+
     def get_email_text_by_uid(self, uid: str, folder: str = 'INBOX', clean_up_html_markup: bool = True) -> str:
         """
         Получи текст письма по его uid.
@@ -110,19 +272,39 @@ class ConnImapEmailServer(ConnEmailServer):
         :param clean_up_html_markup: Очистка текста письма от html-разметки
         """
         log.debug(f'Getting email text by uid "{uid}"...')
-        self.__imap_client.select(folder)
-        result_fetch, raw_email_text = self.__imap_client.uid('fetch', uid, 'BODY.PEEK[TEXT]')
-        email_text = raw_email_text[0][1].decode('utf-8')
-        try:
-            email_text = base64.b64decode(email_text).decode('utf-8')
-        except ValueError:
-            pass
-        try:
-            email_text = quopri.decodestring(email_text).decode('utf-8')
-        except ValueError:
-            pass
-        email_text = email_text.replace('\r', '').replace('\n', '')
-        return re.sub(r'<[^>]*>', '', email_text) if clean_up_html_markup else email_text
+        self._select_folder(folder)
+        # Content-Transfer-Encoding и тело письма получаем одним FETCH
+        result_fetch, raw_email_text = self.__imap_client.uid(
+            'fetch', uid, '(BODY.PEEK[HEADER.FIELDS (CONTENT-TRANSFER-ENCODING)] BODY.PEEK[TEXT])'
+        )
+        raw_email_parts = [item for item in raw_email_text if isinstance(item, tuple)]
+        email_header = next((data for envelope, data in raw_email_parts if b'HEADER.FIELDS' in envelope), b'')
+        email_body = next((data for envelope, data in raw_email_parts if b'BODY[TEXT]' in envelope), None)
+        if email_body is None:
+            log.error(f'Email with uid "{uid}" not found in folder "{folder}"')
+            raise RuntimeError(f'Email with uid "{uid}" not found')
+        transfer_encoding = (_get_header(email_header, _CTE_HEADER_RE) or '').lower()
+        if transfer_encoding == 'base64':
+            email_body = _b64.b64decode(email_body)
+        elif transfer_encoding == 'quoted-printable':
+            email_body = binascii.a2b_qp(email_body)
+        elif not transfer_encoding:
+            # Заголовка нет (например, multipart): пробуем то, что похоже на base64 и quoted-printable
+            if _B64_RE.match(email_body):
+                try:
+                    decoded_body = _b64.b64decode(email_body)
+                    decoded_body.decode('utf-8')
+                    email_body = decoded_body
+                except ValueError:
+                    pass
+            if _QP_RE.search(email_body):
+                email_body = binascii.a2b_qp(email_body)
+        # Разметку и переносы строк удаляем до декодирования: байты '<', '>', '\r' и '\n' не встречаются
+        # внутри многобайтовых символов UTF-8. Разметку удаляем первой: после нее текст обычно заметно короче
+        if clean_up_html_markup:
+            email_body = _HTML_TAG_RE.sub(b'', email_body)
+        email_body = email_body.translate(None, b'\r\n')
+        return email_body.decode('utf-8', errors='replace')
 
     def get_email_received_datetime(self, uid: str, folder: str = 'INBOX') -> datetime:
         """
@@ -131,43 +313,65 @@ class ConnImapEmailServer(ConnEmailServer):
         :param folder: Папка почтового ящика, в которой находится письмо с нужным uid
         """
         log.debug(f'Getting email received datetime by uid "{uid}"...')
-        self.__imap_client.select(folder)
-        result_fetch, raw_email_header = self.__imap_client.uid('fetch', uid, 'BODY.PEEK[HEADER]')
-        email_received = email.message_from_string(raw_email_header[0][1].decode('utf-8')).get('received')
-        email_time_str = ','.join(email_received.split()[-5:-1])
-        return datetime.strptime(email_time_str, '%d,%b,%Y,%H:%M:%S')
+        self._select_folder(folder)
+        result_fetch, raw_email_header = self.__imap_client.uid('fetch', uid, '(BODY.PEEK[HEADER.FIELDS (RECEIVED)])')
+        # В ответе на HEADER.FIELDS первый элемент - кортеж (конверт, заголовки), если письмо найдено
+        if not isinstance(raw_email_header[0], tuple):
+            log.error(f'Email with uid "{uid}" not found in folder "{folder}"')
+            raise RuntimeError(f'Email with uid "{uid}" not found')
+        email_received = _get_header(raw_email_header[0][1], _RECEIVED_HEADER_RE)
+        if email_received is None:
+            log.error(f'Email with uid "{uid}" has no "Received" header')
+            raise RuntimeError(f'Email with uid "{uid}" has no "Received" header')
+        day, month, year, time_str = email_received.split()[-5:-1]
+        hour, minute, second = time_str.split(':')
+        return datetime(int(year), _MONTHS[month], int(day), int(hour), int(minute), int(second))
 
 
 class ConnSmtpEmailServer(ConnEmailServer):
     """Подключение к почтовому серверу по SMTP."""
 
+    # Результаты mimetypes.guess_type по расширению файла
+    _MIME_CACHE: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+
     def __init__(self, host: str,  login: str, password: str, port: int = 465, use_ssl: bool = True) -> None:
         super().__init__(host, port, login, password, use_ssl)
+        self.__smtp_client = None
         self.connect()
 
     def _create_smtp_client(self) -> None:
         """Создай клиент подключения к почтовому серверу."""
         log.debug(f'Connecting to {self.host}:{self.port} via SMTP{" using SSL" if self.use_ssl else ""}...')
-        self.__smtp_client = smtplib.SMTP_SSL(self.host, self.port) if self.use_ssl else \
+        self.__smtp_client = smtplib.SMTP_SSL(self.host, self.port, context=_SSL_CTX) if self.use_ssl else \
             smtplib.SMTP(self.host, self.port)
         log.debug('Connected via SMTP')
 
     def _authenticate(self) -> None:
         """Аутентифицируйся на сервере."""
         log.debug(f'Authenticating with login "{self.login}"...')
-        self.__smtp_client.login(self.login, base64.b64decode(self.password).decode('utf-8'))
+        self.__smtp_client.login(self.login, self.password)
         log.debug('Authenticating success')
 
-    def connect(self):
-        """Подключись к почтовому серверу."""
+    def _open_smtp_client(self) -> smtplib.SMTP:
+        """Создай авторизованный клиент подключения к почтовому серверу."""
         self._create_smtp_client()
         self._authenticate()
+        return self.__smtp_client
+
+    def connect(self) -> None:
+        """Подключись к почтовому серверу."""
+        self.__smtp_client = email_conn_pool.get_or_create(
+            key=('smtp', self.host, self.port, self.login),
+            create=self._open_smtp_client,
+            close=lambda client: client.quit()
+        )
 
     def disconnect(self) -> None:
-        """Отключись от сервера."""
-        log.debug(f'Disconnecting from {self.host}:{self.port}...')
-        self.__smtp_client.quit()
-        log.debug('Disconnected')
+        """Верни подключение в пул. Подключение закрывается при завершении процесса."""
+        if self.__smtp_client is None:
+            return
+        log.debug(f'Releasing connection to {self.host}:{self.port}')
+        self.__smtp_client = None
 
     def send_email(self, email_from: str, email_to: Union[str, List[str]], subject: str, text: str,
                    attachments: Optional[Union[str, List[str]]] = None, add_files_to_zip: bool = True,
@@ -183,36 +387,79 @@ class ConnSmtpEmailServer(ConnEmailServer):
         :param attach_files_using_folder_recursion: Рекурсивно обходить папки с вложениями
         """
         log.debug('Sending email...')
-        self.__check_args_for_send_email(email_to, email_from, attachments)
+        msg = self.create_email(email_from, email_to, subject, text, attachments, add_files_to_zip,
+                                attach_files_using_folder_recursion)
+        self.send_emails([msg])
+
+    def send_emails(self, messages: List[MIMEMultipart]) -> None:
+        """
+        Отправь несколько писем в рамках одной SMTP-сессии.
+        :param messages: Письма, сформированные методом create_email
+        """
+        for msg in messages:
+            # Пул проверяет подключение при выдаче, но сервер мог закрыть его позже. Переподключаемся только
+            # по NOOP перед отправкой: обрыв во время send_message может случиться после приема письма сервером,
+            # и повторная отправка доставила бы его дважды
+            try:
+                self.__smtp_client.noop()
+            except smtplib.SMTPServerDisconnected as e:
+                log.debug(f'SMTP connection to {self.host}:{self.port} lost ({e}). Reconnecting...')
+                self.connect()
+            try:
+                self.__smtp_client.send_message(msg)
+            except smtplib.SMTPServerDisconnected as e:
+                log.error(f'SMTP connection to {self.host}:{self.port} lost while sending email '
+                          f'"{msg["Subject"]}": {e}')
+                raise
+            log.info(f'Email "{msg["Subject"]}" sent to {msg["To"]} from {msg["From"]}')
+
+    def create_email(self, email_from: str, email_to: Union[str, List[str]], subject: str, text: str,
+                     attachments: Optional[Union[str, List[str]]] = None, add_files_to_zip: bool = True,
+                     attach_files_using_folder_recursion: bool = True) -> MIMEMultipart:
+        """
+        Сформируй письмо.
+        :param email_from: Email отправителя
+        :param email_to: Email получателя (получателей)
+        :param subject: Тема письма
+        :param text: Текст письма
+        :param attachments: Путь к файлу (файлам) или папке (папкам)
+        :param add_files_to_zip: Архивация вложений, если их больше 1
+        :param attach_files_using_folder_recursion: Рекурсивно обходить папки с вложениями
+        """
+        recipients = self.__check_args_for_send_email(email_to, email_from, attachments)
         msg = MIMEMultipart()
         msg['Subject'] = subject
         msg['From'] = email_from
-        msg['To'] = email_to if type(email_to) is str else ', '.join(email_to)
+        msg['To'] = ', '.join(recipients)
         msg.attach(MIMEText(text, 'plain'))
         if attachments:
-            attachments = [attachments] if type(attachments) is str else attachments
+            attachments = [attachments] if isinstance(attachments, str) else attachments
             msg = self._attach_files(msg, attachments, attach_files_using_folder_recursion, add_files_to_zip)
-        self.__smtp_client.send_message(msg)
-        log.info(f'Email "{subject}" sent to {", ".join(email_to)} from {email_from}')
+        return msg
 
     @staticmethod
     def __check_args_for_send_email(email_to: Union[str, List[str]], email_from: str,
-                                    attachments: Optional[Union[str, List[str]]] = None) -> None:
-        """Проверь аргументы для отправки письма."""
-        if type(email_to) not in (str, list,):
+                                    attachments: Optional[Union[str, List[str]]] = None) -> Tuple[str, ...]:
+        """
+        Проверь аргументы для отправки письма.
+        :return: Адреса получателей
+        """
+        if not isinstance(email_to, (str, list)):
             log.error(f'Invalid "email_to" type: {type(email_to)}. It should be str or list')
             raise TypeError(f'Invalid "email_to" type: {type(email_to)}')
-        email_to = [email_to] if type(email_to) is str else email_to
-        for i in email_to:
-            if not re.search(r'.+@.+\..+', i):
+        # Строка может содержать несколько адресов через запятую
+        recipients = tuple(i.strip() for i in (email_to.split(',') if isinstance(email_to, str) else email_to))
+        for i in recipients:
+            if not _EMAIL_RE.fullmatch(i):
                 log.error(f'Invalid "email_to" address: "{i}"')
                 raise RuntimeError(f'Invalid "email_to" address: "{i}"')
-        if not re.search(r'.+@.+\..+', email_from):
+        if not _EMAIL_RE.fullmatch(email_from.strip()):
             log.error(f'Invalid "email_from" address: "{email_from}"')
             raise RuntimeError(f'Invalid "email_from" address: "{email_from}"')
-        if attachments and type(attachments) not in (str, list,):
-            log.error(f'Invalid "attachments" type: {type(email_to)}. It should be str or list')
-            raise TypeError(f'Invalid "attachments" type: {type(email_to)}')
+        if attachments and not isinstance(attachments, (str, list)):
+            log.error(f'Invalid "attachments" type: {type(attachments)}. It should be str or list')
+            raise TypeError(f'Invalid "attachments" type: {type(attachments)}')
+        return recipients
 
     def _attach_files(self, mail_body: email.mime.multipart.MIMEMultipart, attachments: List[str],
                       attach_files_using_folder_recursion: bool = True,
@@ -223,13 +470,14 @@ class ConnSmtpEmailServer(ConnEmailServer):
         :param attachments: Список путей к файлам и (или) папкам
         :param attach_files_using_folder_recursion: Рекурсивно обходить папки с вложениями
         """
-        attachments_prepared_for_zip = [
-            a for a in self._prepare_attachments_for_zip(attachments, attach_files_using_folder_recursion)
-        ]
+        attachments_prepared_for_zip = list(
+            self._prepare_attachments_for_zip(attachments, attach_files_using_folder_recursion)
+        )
         if len(attachments_prepared_for_zip) > 1 and add_files_to_zip:
-            zip_file_path = self._add_to_zip(attachments_prepared_for_zip)
-            mail_body = self._add_file_to_mail_body(mail_body, zip_file_path)
-            os.remove(zip_file_path)
+            # Архив собираем в памяти: он не пишется на диск и не читается обратно,
+            # а одновременные отправки не могут перезаписать архивы друг друга
+            zip_buffer = self._add_to_zip(attachments_prepared_for_zip)
+            mail_body = self._add_zip_to_mail_body(mail_body, zip_buffer)
         else:
             for attach in attachments_prepared_for_zip:
                 mail_body = self._add_file_to_mail_body(mail_body, attach.full_path)
@@ -243,53 +491,86 @@ class ConnSmtpEmailServer(ConnEmailServer):
     def _prepare_attachments_for_zip(self, attachments: List[str],
                                      attach_files_using_folder_recursion: bool = True) -> Iterator[AttachForZip]:
         """Подготовь вложения для добавления в zip-архив."""
-        prepared_attachments = []
         for attach in attachments:
-            if os.path.isfile(attach):
-                prepared_attachments.append(self.AttachForZip(full_path=attach, folder_path=os.path.basename(attach)))
-            elif os.path.exists(attach):
-                if not attach_files_using_folder_recursion:
-                    for file in os.listdir(attach):
-                        file_path = os.path.join(attach, file)
-                        if os.path.isfile(file_path) and not file.startswith('.'):
-                            prepared_attachments.append(self.AttachForZip(
-                                full_path=file_path,
-                                folder_path=os.path.join(os.path.basename(attach), file))
-                            )
-                else:
-                    full_main_dir = None
-                    main_dir = None
-                    for current_dir, dirs, files in os.walk(attach):
-                        full_main_dir = current_dir if not full_main_dir else full_main_dir
-                        main_dir = os.path.basename(current_dir) if not main_dir else main_dir
-                        for file_name in files:
-                            if not file_name.startswith('.'):
-                                folder_path = os.path.join(main_dir, file_name) if \
-                                    current_dir == full_main_dir else \
-                                    os.path.join(main_dir, os.path.relpath(current_dir, start=full_main_dir), file_name)
-                                prepared_attachments.append(self.AttachForZip(
-                                    full_path=os.path.join(current_dir, file_name),
-                                    folder_path=folder_path)
-                                )
-            else:
+            try:
+                attach_mode = os.stat(attach).st_mode
+            except OSError:
                 log.warning(f'Invalid attachment: "{attach}"')
-        yield from prepared_attachments
+                continue
+            if stat.S_ISREG(attach_mode):
+                yield self.AttachForZip(full_path=attach, folder_path=os.path.basename(attach))
+            elif not attach_files_using_folder_recursion:
+                with os.scandir(attach) as entries:
+                    for entry in entries:
+                        if entry.is_file() and not entry.name.startswith('.'):
+                            yield self.AttachForZip(full_path=entry.path,
+                                                    folder_path=os.path.join(os.path.basename(attach), entry.name))
+            else:
+                # Пути всех файлов начинаются с attach, поэтому путь в архиве получаем срезом строки
+                main_dir = os.path.basename(os.path.abspath(attach))
+                prefix_len = len(os.path.join(attach, ''))
+                for file_path in self._scan_folder(attach):
+                    yield self.AttachForZip(full_path=file_path, folder_path=main_dir + os.sep + file_path[prefix_len:])
+
+    @staticmethod
+    def _scan_folder(folder: str) -> Iterator[str]:
+        """
+        Рекурсивно обойди папку с вложениями.
+        :param folder: Путь к папке
+        :return: Пути к файлам, кроме скрытых
+        """
+        # Обходим явным стеком: вложенные генераторы на каждом уровне замедляют выдачу каждого файла
+        folders = [folder]
+        while folders:
+            try:
+                entries = os.scandir(folders.pop())
+            except OSError:
+                # Как и os.walk, пропускаем недоступные папки
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # Как и os.walk, не переходим по символическим ссылкам на папки
+                        if not entry.is_symlink():
+                            folders.append(entry.path)
+                    elif not entry.name.startswith('.'):
+                        yield entry.path
 
     @staticmethod
-    def _add_to_zip(files: List[AttachForZip]) -> str:
+    def _add_to_zip(files: List[AttachForZip]) -> io.BytesIO:
         """
         Заархивируй файлы.
         :param files: Файлы, которые необходимо добавить в архив
-        :return: Путь к созданному архиву
+        :return: Буфер с архивом, готовый к чтению с начала
         """
         files_count = len(files)
         log.debug(f'Adding {files_count} files to zip...')
-        zip_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'attachments.zip')
-        with zipfile.ZipFile(zip_path, 'w') as z:
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w', compresslevel=1) as z:
             for file in files:
-                z.write(file.full_path, arcname=file.folder_path, compress_type=zipfile.ZIP_DEFLATED)
+                ext = os.path.splitext(file.full_path)[1].lower()
+                maintype = (ConnSmtpEmailServer._guess_mime_type(file.full_path)[0] or '').split('/', 1)[0]
+                if ext in _PRECOMPRESSED or maintype in _PRECOMPRESSED_MAINTYPES:
+                    compress_type = zipfile.ZIP_STORED
+                else:
+                    compress_type = zipfile.ZIP_DEFLATED
+                z.write(file.full_path, arcname=file.folder_path, compress_type=compress_type)
             log.debug(f'{files_count} files successfully added to archive')
-        return zip_path
+        zip_buffer.seek(0)
+        return zip_buffer
+
+    @staticmethod
+    def _guess_mime_type(filename: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Определи MIME-тип файла по расширению с кешированием.
+        :param filename: Имя или путь к файлу
+        :return: MIME-тип и кодировка, как в mimetypes.guess_type
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        mime_type = ConnSmtpEmailServer._MIME_CACHE.get(ext)
+        if mime_type is None:
+            mime_type = ConnSmtpEmailServer._MIME_CACHE[ext] = mimetypes.guess_type(filename)
+        return mime_type
 
     @staticmethod
     def _add_file_to_mail_body(mail_body: email.mime.multipart.MIMEMultipart,
@@ -300,24 +581,34 @@ class ConnSmtpEmailServer(ConnEmailServer):
         :param filepath: Путь к файлу
         """
         filename = os.path.basename(filepath)
-        ctype, encoding = mimetypes.guess_type(filepath)
+        ctype, encoding = ConnSmtpEmailServer._guess_mime_type(filename)
         if not ctype or encoding:
             ctype = 'application/octet-stream'
         maintype, subtype = ctype.split('/', 1)
         if maintype == 'text':
             with open(filepath) as fp:
                 file = MIMEText(fp.read(), _subtype=subtype)
-        elif maintype == 'image':
-            with open(filepath, 'rb') as fp:
-                file = MIMEImage(fp.read(), _subtype=subtype)
-        elif maintype == 'audio':
-            with open(filepath, 'rb') as fp:
-                file = MIMEAudio(fp.read(), _subtype=subtype)
         else:
+            # Картинки и аудио тоже кодируем по частям: MIMEImage/MIMEAudio читают файл целиком
             with open(filepath, 'rb') as fp:
                 file = MIMEBase(maintype, subtype)
-                file.set_payload(fp.read())
-                encoders.encode_base64(file)
+                file.set_payload(_encode_file_base64(fp))
+                file['Content-Transfer-Encoding'] = 'base64'
         file.add_header('Content-Disposition', 'attachment', filename=filename)
         mail_body.attach(file)
         return mail_body
+
+    @staticmethod
+    def _add_zip_to_mail_body(mail_body: email.mime.multipart.MIMEMultipart,
+                              zip_buffer: BinaryIO) -> email.mime.multipart.MIMEMultipart:
+        """
+        Добавь zip-архив с вложениями к телу письма.
+        :param mail_body: Тело письма
+        :param zip_buffer: Архив, открытый на чтение
+        """
+        file = MIMEBase('application', 'zip')
+        file.set_payload(_encode_file_base64(zip_buffer))
+        file['Content-Transfer-Encoding'] = 'base64'
+        file.add_header('Content-Disposition', 'attachment', filename='attachments.zip')
+        mail_body.attach(file)
+        return mail_body
@@ -0,0 +1,62 @@
+import atexit
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class ConnPool:
+    """Пул подключений, живущих до конца работы процесса."""
+
+    def __init__(self) -> None:
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__all_pools: List[Dict[Hashable, Tuple[Any, Callable[[Any], Any]]]] = []
+
+    def _get_thread_pool(self) -> Dict[Hashable, Tuple[Any, Callable[[Any], Any]]]:
+        """Получи подключения текущего потока."""
+        pool = getattr(self.__local, 'pool', None)
+        if pool is None:
+            pool = self.__local.pool = {}
+            with self.__lock:
+                self.__all_pools.append(pool)
+        return pool
+
+    def get_or_create(self, key: Hashable, create: Callable[[], Any], close: Callable[[Any], Any]) -> Any:
+        """
+        Получи живое подключение из пула или создай новое.
+        :param key: Ключ подключения, например: (протокол, хост, порт, логин)
+        :param create: Функция, создающая авторизованное подключение
+        :param close: Функция, закрывающая подключение
+        """
+        pool = self._get_thread_pool()
+        if key in pool:
+            handle, _ = pool[key]
+            try:
+                handle.noop()
+                log.debug(f'Reusing pooled connection {key}')
+                return handle
+            except Exception as e:
+                log.debug(f'Pooled connection {key} is dead ({e}). Reconnecting...')
+                pool.pop(key)
+        handle = create()
+        pool[key] = (handle, close)
+        return handle
+
+    def close_all(self) -> None:
+        """Закрой все подключения пула."""
+        with self.__lock:
+            pools = list(self.__all_pools)
+        for pool in pools:
+            while pool:
+                key, (handle, close) = pool.popitem()
+                try:
+                    close(handle)
+                    log.debug(f'Pooled connection {key} closed')
+                except Exception as e:
+                    log.debug(f'Failed to close pooled connection {key}: {e}')
+
+
+email_conn_pool = ConnPool()
+atexit.register(email_conn_pool.close_all)
@@ -1,26 +1,83 @@
+import io
 import logging
 import os
 import time
+from contextlib import contextmanager
 from functools import wraps
 from typing import Optional, Union, List, Iterator
+from uuid import uuid4
 
 import pandas as pd
 import psycopg2
-from psycopg2 import extensions
+from psycopg2 import extensions, extras, sql
 from sqlalchemy import create_engine
 
 log = logging.getLogger(__name__)
 
+# Режимы df.to_sql для случая, когда таблица уже существует
+_IF_EXISTS_MODES = ('fail', 'replace', 'append')
+
+
+def _identifier(name: str) -> sql.Composable:
+    """
+    Экранируй имя объекта БД, в том числе с указанием схемы через точку.
+    :param name: Имя объекта, например: название_схемы.название_таблицы
+    """
+    return sql.SQL('.').join([sql.Identifier(part) for part in name.split('.')])
+
+
+class _ClosingChunks:
+    """Чанки результата запроса, которые закрывают свое подключение, когда закончились или больше не нужны."""
+
+    def __init__(self, chunks: Iterator[pd.DataFrame], con) -> None:
+        """
+        :param chunks: Чанки результата запроса
+        :param con: Подключение, через которое читается результат
+        """
+        self.__chunks = chunks
+        self.__con = con
+
+    def __iter__(self) -> '_ClosingChunks':
+        return self
+
+    def __next__(self) -> pd.DataFrame:
+        if self.__con is None:
+            raise StopIteration
+        try:
+            return next(self.__chunks)
+        except BaseException:
+            # И конец данных (StopIteration), и ошибка чтения освобождают подключение
+            self.close()
+            raise
+
+    def __enter__(self) -> '_ClosingChunks':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Закрой подключение. В отличие от незапущенного генератора, срабатывает и до начала чтения."""
+        if self.__con is None:
+            return
+        close_chunks = getattr(self.__chunks, 'close', None)
+        if close_chunks is not None:
+            close_chunks()
+        self.__con.close()
+        self.__con = None
+
 
 def timeit(f):
     """Декоратор. Измерь время выполнения функции и запиши его в лог."""
     @wraps(f)
     def log_time(*args, **kwargs):
+        # Аргумент 'log_time' нужен только декоратору, в саму функцию его не передаем.
+        # Время замеряем, только если его попросили записать и запись INFO в лог включена
+        if not kwargs.pop('log_time', False) or not log.isEnabledFor(logging.INFO):
+            return f(*args, **kwargs)
         time_start = time.monotonic()
         result = f(*args, **kwargs)
-        time_stop = time.monotonic()
-        if 'log_time' in kwargs and 'log_time':
-            log.info(f'{f.__name__.upper()} completed in {round((time_stop - time_start), 3)} sec')
+        log.info(f'{f.__name__.upper()} completed in {round((time.monotonic() - time_start), 3)} sec')
         return result
     return log_time
 
@@ -46,7 +103,10 @@ class ConnPostgreSQL:
         self.__conn = psycopg2.connect(dbname=dbname, host=host, port=port, user=user, password=password,
                                        application_name=application_name)
         self.__conn.autocommit = True
-        self.__engine = create_engine(f'postgresql://{user}:{password}@{host}{port_str}/{dbname}')
+        self.__in_transaction = False
+        # stream_results: результаты SELECT читаются через серверный курсор, а не загружаются в память целиком
+        self.__engine = create_engine(f'postgresql://{user}:{password}@{host}{port_str}/{dbname}',
+                                      execution_options={'stream_results': True})
         log.debug(f'Connected to PostgreSQL database "{dbname}"')
 
     dbname = property(lambda self: self.__dbname)
@@ -73,6 +133,35 @@ class ConnPostgreSQL:
             lambda self: (self.__table_data,) if type(self.__table_data) is pd.DataFrame else self.__table_data
         )
 
+        def __enter__(self) -> 'ConnPostgreSQL.PgTable':
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+            self.close()
+
+        def close(self) -> None:
+            """Закрой подключение, через которое читаются данные таблицы, если они прочитаны не до конца."""
+            if isinstance(self.__table_data, _ClosingChunks):
+                self.__table_data.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Выполни запросы блока одной транзакцией: COMMIT при успехе, ROLLBACK при ошибке.
+        Вложенный блок выполняется в транзакции внешнего.
+        """
+        if self.__in_transaction:
+            yield
+            return
+        self.__conn.autocommit = False
+        self.__in_transaction = True
+        try:
+            with self.__conn:
+                yield
+        finally:
+            self.__in_transaction = False
+            self.__conn.autocommit = True
+
     def create_database(self, db_name: str, revoke_connect_from_public: bool = True) -> None:
         """
         Создай новую базу данных.
@@ -80,12 +169,13 @@ class ConnPostgreSQL:
         :param revoke_connect_from_public: Отозвать доступ к созданной БД у привилегии Public
         """
         with self.__conn.cursor() as cur:
-            cur.execute(f'CREATE DATABASE {db_name} OWNER {self.__user}')
+            cur.execute(sql.SQL('CREATE DATABASE {} OWNER {}').format(sql.Identifier(db_name),
+                                                                      sql.Identifier(self.__user)))
         log.info(f'Database "{db_name}" created. Owner: {self.__user}')
 
         if revoke_connect_from_public:
             with self.__conn.cursor() as cur:
-                cur.execute(f'REVOKE CONNECT ON DATABASE {db_name} FROM PUBLIC')
+                cur.execute(sql.SQL('REVOKE CONNECT ON DATABASE {} FROM PUBLIC').format(sql.Identifier(db_name)))
             log.debug(f'Connection access to "{db_name}" revoked from Public')
 
     def delete_database(self, db_name: str) -> None:
@@ -94,7 +184,7 @@ class ConnPostgreSQL:
         :param db_name: Название базы данных
         """
         with self.__conn.cursor() as cur:
-            cur.execute(f'DROP DATABASE {db_name}')
+            cur.execute(sql.SQL('DROP DATABASE {}').format(sql.Identifier(db_name)))
         log.info(f'Database "{db_name}" deleted')
 
     def disconnect(self) -> None:
@@ -109,7 +199,7 @@ class ConnPostgreSQL:
         :param pg_schema_name: Название схемы
         """
         with self.__conn.cursor() as cur:
-            cur.execute(f'CREATE SCHEMA IF NOT EXISTS {pg_schema_name}')
+            cur.execute(sql.SQL('CREATE SCHEMA IF NOT EXISTS {}').format(sql.Identifier(pg_schema_name)))
         log.info(f'Schema "{pg_schema_name}" created (if not existed) in database "{self.__dbname}"')
 
     def delete_pg_schema(self, pg_schema_name: str, cascade: bool = False) -> None:
@@ -119,7 +209,8 @@ class ConnPostgreSQL:
         :param cascade: Автоматически удалять объекты, содержащиеся в этой схеме, и все зависящие от них объекты
         """
         with self.__conn.cursor() as cur:
-            cur.execute(f'DROP SCHEMA IF EXISTS {pg_schema_name} {"CASCADE" if cascade else ""}')
+            cur.execute(sql.SQL('DROP SCHEMA IF EXISTS {} {}').format(sql.Identifier(pg_schema_name),
+                                                                      sql.SQL('CASCADE' if cascade else '')))
         log.info(f'Schema "{pg_schema_name}" deleted (if existed) from database "{self.__dbname}"')
 
     def create_partition_table(self, master_table_name: str, partition_table_name: str) -> str:
@@ -131,8 +222,11 @@ class ConnPostgreSQL:
         """
         log.debug(f'Creating partition table "{partition_table_name}" for table "{master_table_name}"...')
         with self.__conn.cursor() as cur:
-            cur.execute(f'CREATE TABLE IF NOT EXISTS {partition_table_name} ( LIKE {master_table_name} INCLUDING ALL )')
-            cur.execute(f'ALTER TABLE {partition_table_name} INHERIT {master_table_name}')
+            cur.execute(sql.SQL('CREATE TABLE IF NOT EXISTS {} ( LIKE {} INCLUDING ALL )').format(
+                _identifier(partition_table_name), _identifier(master_table_name)
+            ))
+            cur.execute(sql.SQL('ALTER TABLE {} INHERIT {}').format(_identifier(partition_table_name),
+                                                                    _identifier(master_table_name)))
         log.info(f'Partition table "{partition_table_name}" created')
         return partition_table_name
 
@@ -140,7 +234,7 @@ class ConnPostgreSQL:
         """Получи размер базы данных."""
         with self.__conn.cursor() as cur:
             cur.execute('SELECT pg_size_pretty(pg_database_size(current_database()))')
-            result = [r for r in cur][0][0]
+            result = cur.fetchone()[0]
         log.debug(f'Database "{self.__dbname}" size: {result}')
         return result
 
@@ -149,7 +243,7 @@ class ConnPostgreSQL:
         with self.__conn.cursor() as cur:
             cur.execute("SELECT CONCAT(table_schema, '.', table_name) FROM information_schema.tables WHERE "
                         "table_schema NOT IN ('information_schema','pg_catalog')")
-            result = [r[0] for r in cur]
+            result = [r for r, in cur.fetchall()]
         log.debug(f'Database "{self.__dbname}" table\'s names: {result}')
         return result
 
@@ -158,26 +252,39 @@ class ConnPostgreSQL:
         Посчитай количество строк в таблице.
         :param table: Название таблицы в формате название_схемы.название_таблицы
         """
-        schema_name = table.split('.')[0]
-        table_name = table.split('.')[1]
+        schema_name, table_name = table.split('.', 1)
         with self.__conn.cursor() as cur:
-            cur.execute(f"SELECT COUNT(*) FROM {schema_name}.{table_name}")
-            result = [r[0] for r in cur][0]
+            cur.execute(sql.SQL('SELECT COUNT(*) FROM {}.{}').format(sql.Identifier(schema_name),
+                                                                     sql.Identifier(table_name)))
+            result = cur.fetchone()[0]
         log.debug(f'Table "{table}" rows count: {result}')
         return result
 
+    def table_exists(self, table: str) -> bool:
+        """
+        Проверь, существует ли таблица.
+        :param table: Название таблицы в формате название_схемы.название_таблицы
+        """
+        schema_name, table_name = table.split('.', 1)
+        with self.__conn.cursor() as cur:
+            cur.execute('SELECT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.TABLES '
+                        'WHERE table_name = %s AND table_schema = %s)', (table_name, schema_name))
+            result = cur.fetchone()[0]
+        log.debug(f'Table "{table}" exists: {result}')
+        return result
+
     def get_table_schema(self, table: str) -> Union[List[dict], None]:
         """
         Получи схему таблицы.
         :param table: Название таблицы в формате название_схемы.название_таблицы
         :return: Схема таблицы, если таблица существует, в противном случае - None
         """
-        schema_name = table.split('.')[0]
-        table_name = table.split('.')[1]
+        schema_name, table_name = table.split('.', 1)
         with self.__conn.cursor() as cur:
-            cur.execute(f"SELECT column_name, column_default, data_type FROM INFORMATION_SCHEMA.COLUMNS "
-                        f"WHERE table_name = '{table_name}' AND table_schema = '{schema_name}'")
-            result = [{'column_name': r[0], 'column_default_value': r[1], 'column_type': r[2]} for r in cur]
+            cur.execute('SELECT column_name, column_default, data_type FROM INFORMATION_SCHEMA.COLUMNS '
+                        'WHERE table_name = %s AND table_schema = %s', (table_name, schema_name))
+            result = [{'column_name': column_name, 'column_default_value': column_default, 'column_type': data_type}
+                      for column_name, column_default, data_type in cur.fetchall()]
         if not result:
             log.error(f'Table "{table}" not found in "{self.__dbname}" PostgreSQL database')
             return
@@ -185,29 +292,48 @@ class ConnPostgreSQL:
         return result
 
     @timeit
-    def run_sql_query(self, query: str, **kwargs) -> extensions.cursor:
+    def run_sql_query(self, query: str, params: Optional[Union[tuple, dict]] = None, server_side: bool = False,
+                      itersize: int = 10000, **kwargs) -> extensions.cursor:
         """
         Выполни SQL-запрос.
+        Курсор возвращается открытым: закрыть его должен вызывающий код.
         :param query: SQL-запрос
+        :param params: Параметры запроса для плейсхолдеров %s или %(name)s
+        :param server_side: Использовать серверный курсор: строки результата SELECT передаются по мере чтения
+        :param itersize: Количество строк, получаемых серверным курсором за один запрос к серверу
         """
         log.info(f'Running PostgreSQL query: {" ".join(query.split())}')
-        with self.__conn.cursor() as cur:
-            cur.execute(query)
-            return cur
+        if server_side:
+            # В режиме autocommit именованный курсор должен переживать завершение транзакции
+            cur = self.__conn.cursor(name=f'ss_{uuid4().hex}', withhold=True)
+            cur.itersize = itersize
+        else:
+            cur = self.__conn.cursor()
+        try:
+            cur.execute(query, params)
+        except Exception:
+            cur.close()
+            raise
+        return cur
 
     @timeit
     def run_sql_query_to_df(self, query: str, chunksize: int = 10000, **kwargs) -> Iterator[pd.DataFrame]:
         """
         Выполни SQL-запрос и получи результат в датафрейме.
         Можно передавать любые аргументы метода pandas.read_sql_query.
+        Чанки читаются через открытое подключение: их нужно дочитать до конца или вызвать close() у результата,
+        иначе подключение и серверный курсор остаются открытыми до сборки мусора.
         :param query: SQL-запрос
         :param chunksize: Размер чанков
         """
-        # Аргумент 'log_time' нужен только для декоратора @timeit
-        kwargs = self._remove_log_time_from_kwargs(kwargs)
-
         log.info(f'Running PostgreSQL query: {" ".join(query.split())}')
-        return pd.read_sql_query(query, con=self.__engine, chunksize=chunksize, **kwargs)
+        con = self._connect_for_streaming(chunksize)
+        try:
+            chunks = pd.read_sql_query(query, con=con, chunksize=chunksize, **kwargs)
+        except Exception:
+            con.close()
+            raise
+        return _ClosingChunks(chunks, con)
 
     @timeit
     def get_table(self, table_name: str, pg_schema_name: str = 'public', chunksize: int = 10000,
@@ -215,60 +341,179 @@ class ConnPostgreSQL:
         """
         Получи таблицу из базы данных.
         Можно передавать любые аргументы метода pandas.read_sql_table.
+        Чанки читаются через открытое подключение: их нужно дочитать до конца или закрыть таблицу
+        (table.close() или with table), иначе подключение и серверный курсор остаются открытыми до сборки мусора.
         :param table_name: Название таблицы
         :param pg_schema_name: Название схемы БД
         :param chunksize: Размер чанков
         :return: Таблица, если она существует, в противном случае - None
         """
-        # Аргумент 'log_time' нужен только для декоратора @timeit
-        kwargs = self._remove_log_time_from_kwargs(kwargs)
-
         log.info(f'Fetching table "{pg_schema_name}.{table_name}" from PostgreSQL database "{self.__dbname}"...')
+        con = self._connect_for_streaming(chunksize)
         try:
             table_data = pd.read_sql_table(
-                table_name, con=self.__engine, schema=pg_schema_name, chunksize=chunksize, **kwargs
+                table_name, con=con, schema=pg_schema_name, chunksize=chunksize, **kwargs
             )
-            return self.PgTable(pg_schema_name=pg_schema_name, table_name=table_name, table_data=table_data)
         except ValueError as e:
+            con.close()
             if 'not found' in str(e):
                 return
             raise e
+        except Exception:
+            con.close()
+            raise
+        return self.PgTable(pg_schema_name=pg_schema_name, table_name=table_name,
+                            table_data=_ClosingChunks(table_data, con))
+
+    def _connect_for_streaming(self, chunksize: int):
+        """
+        Открой подключение SQLAlchemy, читающее результат серверным курсором.
+        :param chunksize: Размер чанков: столько строк подключение держит в буфере
+        """
+        return self.__engine.connect().execution_options(stream_results=True, max_row_buffer=chunksize)
 
     @timeit
     def set_table(self, table: PgTable, if_exists: str = 'fail', chunksize: Optional[int] = 10000, index: bool = False,
-                  **kwargs) -> None:
+                  use_copy: bool = True, dtype: Optional[dict] = None) -> None:
         """
         Запиши датафрейм в таблицу PostgreSQL.
-        Можно передавать любые аргументы метода df.to_sql.
+        Структура таблицы создается как в df.to_sql, строки загружаются через COPY или execute_values.
         :param table: Таблица
-        :param if_exists: Действие если таблица существует: 'fail', 'replace' или 'append'
+        :param if_exists: Действие если таблица существует: 'fail', 'replace', 'append' или 'truncate' -
+            очистить таблицу, сохранив ее структуру
         :param chunksize: Количество строк таблицы для записи в одном запросе
         :param index: Записать индекс датафрейма как отдельную колонку
+        :param use_copy: Загружать строки через COPY, иначе - через INSERT с execute_values
+        :param dtype: Типы колонок создаваемой таблицы, как в df.to_sql
         """
-        # Аргумент 'log_time' нужен только для декоратора @timeit
-        kwargs = self._remove_log_time_from_kwargs(kwargs)
+        if if_exists not in _IF_EXISTS_MODES and if_exists != 'truncate':
+            log.error(f'Invalid "if_exists" value: "{if_exists}"')
+            raise ValueError(f'Invalid "if_exists" value: "{if_exists}"')
+        if if_exists != 'truncate':
+            self._write_table_data(table, if_exists, chunksize, index, use_copy, dtype)
+            return
+
+        # Очистку и загрузку выполняем одной транзакцией: пустую таблицу никто не увидит
+        with self.transaction():
+            self._write_table_data(table, 'append', chunksize, index, use_copy, dtype, truncate=True)
 
+    def _write_table_data(self, table: PgTable, if_exists: str, chunksize: Optional[int], index: bool,
+                          use_copy: bool, dtype: Optional[dict] = None, truncate: bool = False) -> None:
+        """
+        Запиши чанки таблицы в PostgreSQL.
+        :param table: Таблица
+        :param if_exists: Действие если таблица существует: 'fail', 'replace' или 'append'
+        :param chunksize: Количество строк таблицы для записи в одном запросе
+        :param index: Записать индекс датафрейма как отдельную колонку
+        :param use_copy: Загружать строки через COPY, иначе - через INSERT с execute_values
+        :param dtype: Типы колонок создаваемой таблицы, как в df.to_sql
+        :param truncate: Очистить таблицу перед записью первого чанка
+        """
         pg_schema_name = table.pg_schema_name
         table_name = table.table_name
         table_data = table.table_data
 
+        write_rows = self._copy_from_df if use_copy else self._insert_from_df
         counter = 1
         for df in table_data:
             log.info(f'Writing {len(df)} rows to table "{pg_schema_name}.{table_name}"...')
-            df.to_sql(table_name, schema=pg_schema_name, con=self.__engine, chunksize=chunksize, method='multi',
-                      index=index, if_exists=if_exists if counter == 1 else 'append', **kwargs)
+            if index:
+                df = df.reset_index()
+            if counter == 1:
+                # Индекс (если нужен) уже стал колонкой после reset_index, поэтому в структуру таблицы его не добавляем
+                self._create_table(df, table_name, pg_schema_name, if_exists, dtype)
+                if truncate:
+                    with self.__conn.cursor() as cur:
+                        cur.execute(sql.SQL('TRUNCATE {}').format(self._get_table_identifier(table_name,
+                                                                                             pg_schema_name)))
+                    log.debug(f'Table "{pg_schema_name}.{table_name}" truncated')
+            write_rows(df, table_name, pg_schema_name, chunksize)
             log.info(f'{len(df)} rows successfully written to table "{pg_schema_name}.{table_name}"')
             counter += 1
 
+    def _create_table(self, df: pd.DataFrame, table_name: str, pg_schema_name: Optional[str], if_exists: str,
+                      dtype: Optional[dict] = None) -> None:
+        """
+        Создай таблицу под датафрейм, как это сделал бы df.to_sql, но без записи строк.
+        Типы колонок pandas определяет по всем строкам датафрейма, а не по пустому срезу.
+        :param df: Датафрейм с данными
+        :param table_name: Название таблицы
+        :param pg_schema_name: Название схемы БД
+        :param if_exists: Действие если таблица существует: 'fail', 'replace' или 'append'
+        :param dtype: Типы колонок, как в df.to_sql
+        """
+        # Неизвестный режим не должен дойти до DROP TABLE
+        if if_exists not in _IF_EXISTS_MODES:
+            log.error(f'Invalid "if_exists" value: "{if_exists}"')
+            raise ValueError(f'Invalid "if_exists" value: "{if_exists}"')
+        table_identifier = self._get_table_identifier(table_name, pg_schema_name)
+        if self.table_exists(f'{pg_schema_name or "public"}.{table_name}'):
+            if if_exists == 'fail':
+                log.error(f'Table "{pg_schema_name}.{table_name}" already exists')
+                raise ValueError(f'Table "{pg_schema_name}.{table_name}" already exists')
+            if if_exists == 'append':
+                return
+            with self.__conn.cursor() as cur:
+                cur.execute(sql.SQL('DROP TABLE {}').format(table_identifier))
+        ddl = pd.io.sql.get_schema(df, table_name, con=self.__engine, schema=pg_schema_name, dtype=dtype)
+        with self.__conn.cursor() as cur:
+            cur.execute(ddl)
+        log.debug(f'Table "{pg_schema_name}.{table_name}" created')
+
+    def _copy_from_df(self, df: pd.DataFrame, table_name: str, pg_schema_name: Optional[str] = None,
+                      chunksize: Optional[int] = 10000) -> None:
+        """
+        Загрузи строки датафрейма в существующую таблицу через COPY FROM STDIN.
+        :param df: Датафрейм с данными
+        :param table_name: Название таблицы
+        :param pg_schema_name: Название схемы БД
+        :param chunksize: Количество строк в одном COPY
+        """
+        query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+            self._get_table_identifier(table_name, pg_schema_name), self._get_columns_identifiers(df)
+        )
+        step = chunksize or max(len(df), 1)
+        with self.__conn.cursor() as cur:
+            for start in range(0, len(df), step):
+                buffer = io.StringIO()
+                df.iloc[start:start + step].to_csv(buffer, index=False, header=False, na_rep='\\N')
+                buffer.seek(0)
+                cur.copy_expert(query, buffer)
+
+    def _insert_from_df(self, df: pd.DataFrame, table_name: str, pg_schema_name: Optional[str] = None,
+                        chunksize: Optional[int] = 10000) -> None:
+        """
+        Загрузи строки датафрейма в существующую таблицу через INSERT с execute_values.
+        Подходит, когда COPY недоступен.
+        :param df: Датафрейм с данными
+        :param table_name: Название таблицы
+        :param pg_schema_name: Название схемы БД
+        :param chunksize: Количество строк в одном INSERT
+        """
+        query = sql.SQL('INSERT INTO {} ({}) VALUES %s').format(
+            self._get_table_identifier(table_name, pg_schema_name), self._get_columns_identifiers(df)
+        )
+        # Пропуски pandas (NaN, NaT) записываем как NULL
+        rows = df.astype(object).where(pd.notnull(df), None).itertuples(index=False, name=None)
+        with self.__conn.cursor() as cur:
+            extras.execute_values(cur, query, rows, page_size=chunksize or max(len(df), 1))
+
     @staticmethod
-    def _remove_log_time_from_kwargs(kwargs: dict) -> dict:
+    def _get_table_identifier(table_name: str, pg_schema_name: Optional[str] = None) -> sql.Composable:
         """
-        Удали аргумент 'log_time' из kwargs.
-        :param kwargs: Словарь аргументов.
+        Получи экранированное имя таблицы.
+        :param table_name: Название таблицы
+        :param pg_schema_name: Название схемы БД
         """
-        try:
-            kwargs.pop('log_time')
-        except KeyError:
-            pass
-        finally:
-            return kwargs
+        table = sql.Identifier(table_name)
+        if pg_schema_name:
+            table = sql.SQL('.').join([sql.Identifier(pg_schema_name), table])
+        return table
+
+    @staticmethod
+    def _get_columns_identifiers(df: pd.DataFrame) -> sql.Composable:
+        """
+        Получи экранированный список колонок датафрейма через запятую.
+        :param df: Датафрейм с данными
+        """
+        return sql.SQL(', ').join(sql.Identifier(str(column)) for column in df.columns)
@@ -36,10 +36,13 @@ class MainProcessor:
                                search_regex=self.__cfg.parser.search_regex).run()
         results = HhParserResultsProcessor(hh_parsed_data=raw_results, pg_conn=self.__conn_pg).run()
 
-        self._load_df_to_postgres(df=results.df_parsing_results, table_name='parsing_results', if_exists='append')
-        self._load_df_to_postgres(df=results.df_current_jobs, table_name='current_jobs', if_exists='replace')
-        self._load_df_to_postgres(df=results.df_unique_jobs, table_name='unique_jobs', if_exists='append')
-        self._load_df_to_postgres(df=results.df_unique_closed_jobs, table_name='unique_closed_jobs', if_exists='append')
+        # Все таблицы обновляем одной транзакцией: один COMMIT и согласованные данные при ошибке
+        with self.__conn_pg.transaction():
+            self._load_df_to_postgres(df=results.df_parsing_results, table_name='parsing_results', if_exists='append')
+            self._load_df_to_postgres(df=results.df_current_jobs, table_name='current_jobs', if_exists='truncate')
+            self._load_df_to_postgres(df=results.df_unique_jobs, table_name='unique_jobs', if_exists='append')
+            self._load_df_to_postgres(df=results.df_unique_closed_jobs, table_name='unique_closed_jobs',
+                                      if_exists='append')
 
         report_path = ReportFileProcessor(hh_parsed_data=results).create_report_file()
         if self.__args.send_email:
@@ -1,19 +1,61 @@
 import datetime
 import logging
-import random
 import re
+import threading
 import time
-from typing import Iterator, List, Union, Dict
-from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Union, Dict
 
+import lxml.html
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .conn_postgresql import ConnPostgreSQL
 
 log = logging.getLogger(__name__)
 
+# Заголовки всех запросов к hh.ru
+_DEFAULT_HEADERS = {
+    'accept': '*/*',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/76.0.3809.100 Safari/537.36'
+}
+# Количество одновременных запросов к hh.ru
+_MAX_FETCH_WORKERS = 8
+# Общий для всех парсеров процесса предел одновременных запросов: конфигурации обрабатываются параллельно,
+# и без него каждая добавляла бы к нагрузке на hh.ru еще _MAX_FETCH_WORKERS запросов
+_HH_REQUESTS_SEMAPHORE = threading.BoundedSemaphore(_MAX_FETCH_WORKERS)
+# Номера месяцев для дат публикации вакансий
+_MONTHS = {
+    'января': '01',
+    'февраля': '02',
+    'марта': '03',
+    'апреля': '04',
+    'мая': '05',
+    'июня': '06',
+    'июля': '07',
+    'августа': '08',
+    'сентября': '09',
+    'октября': '10',
+    'ноября': '11',
+    'декабря': '12'
+}
+_MONTHS_RE = re.compile('|'.join(_MONTHS))
+# Зарплата: необязательные "от"/"до", число и вторая граница вилки через дефис
+_SALARY_RE = r'^(?:(от|до)\s+)?(\d+)(?:-(\d+))?'
+# XPath-выражения для разбора страниц выдачи, компилируются один раз
+_XP_PAGER = etree.XPath('//a[@data-qa="pager-page"]')
+_XP_VACANCY = etree.XPath('//div[@data-qa="vacancy-serp__vacancy" '
+                          'or @data-qa="vacancy-serp__vacancy vacancy-serp__vacancy_premium"]')
+_XP_TITLE = etree.XPath('.//a[@data-qa="vacancy-serp__vacancy-title"]')
+_XP_EMPLOYER = etree.XPath('.//a[@data-qa="vacancy-serp__vacancy-employer"]')
+_XP_DATE = etree.XPath('.//span[contains(concat(" ", normalize-space(@class), " "), '
+                       '" vacancy-serp-item__publication-date ")]')
+_XP_SALARY = etree.XPath('.//span[@data-qa="vacancy-serp__vacancy-compensation"]')
+
 
 class HhParser:
     """Парсер hh.ru."""
@@ -29,21 +71,22 @@ class HhParser:
         self.__search_period = search_period
         self.__search_text = search_text
         self.__search_regex = search_regex
+        self.__search_regex_compiled = re.compile(search_regex, flags=re.IGNORECASE)
         self.__base_url = 'https://hh.ru/search/vacancy'
         self.__url_params = {
             'search_period': self.__search_period,
             'clusters': 'true',
             'area': self.__area,
-            'text': quote(self.__search_text),
+            'text': self.__search_text,
             'enable_snippets': 'true',
             'page': 0
         }
         self.__session = requests.Session()
-        self.__headers = {
-            'accept': '*/*',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/76.0.3809.100 Safari/537.36'
-        }
+        self.__session.headers.update(_DEFAULT_HEADERS)
+        # Пул соединений рассчитан на все потоки загрузки, повторы запросов выполняет urllib3
+        retry = Retry(total=4, backoff_factor=1, status_forcelist=[403, 500, 503], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_MAX_FETCH_WORKERS, max_retries=retry)
+        self.__session.mount('https://', adapter)
 
     area = property(lambda self: self.__area)
     search_period = property(lambda self: self.__search_period)
@@ -70,30 +113,15 @@ class HhParser:
 
         data = property(lambda self: self.__data)
 
-    @staticmethod
-    def _get_url_with_params(url: str, params: dict) -> str:
-        """
-        Сформируй URL с параметрами.
-        :param url: URL
-        :param params: Параметры URL
-        """
-        return f'{url}?' + '&'.join([f'{k}={v}' for k, v in params.items()])
-
-    def _get_urls_pages_with_vacancies(self) -> Iterator[str]:
-        """Получи URL страниц с вакансиями."""
-        start_url = self._get_url_with_params(self.__base_url, self.__url_params)
-        urls = [start_url]
-        response = self.__exponential_backoff(start_url)
+    def _get_pages_params(self) -> Iterator[dict]:
+        """Получи параметры запросов страниц с вакансиями."""
+        response = self.__request_page(self.__base_url, self.__url_params)
         if response is not False:
-            result = BeautifulSoup(response.content, 'lxml')
-            pages = result.find_all('a', attrs={'data-qa': 'pager-page'})
-            page_count = int(pages[-1].text)
-            url_params = self.__url_params
-            for i in range(page_count - 1):
-                url_params['page'] = i + 1
-                urls.append(self._get_url_with_params(self.__base_url, url_params))
-            log.info(f'Found {len(urls)} pages with "{self.__search_text}" vacancies')
-            yield from urls
+            pages = _XP_PAGER(lxml.html.fromstring(response.text))
+            page_count = int(pages[-1].text_content())
+            log.info(f'Found {page_count} pages with "{self.__search_text}" vacancies')
+            for i in range(page_count):
+                yield {**self.__url_params, 'page': i}
         else:
             log.error(f'Start request failed')
             raise RuntimeError('Request failed')
@@ -102,36 +130,28 @@ class HhParser:
         """Запусти парсер."""
         time_start = time.monotonic()
         log.info(f'Looking for "{self.__search_text}" vacancies on hh.ru...')
-        vacancies_pages_urls = self._get_urls_pages_with_vacancies()
-
-        raw_vacancies_data = []
-        url_counter = 1
-        for url in vacancies_pages_urls:
-            log.info(f'Parsing page {url_counter}...')
-            response = self.__exponential_backoff(url)
-            if response is not False:
-                result = BeautifulSoup(response.content, 'lxml')
-                vacancies_divs = result.find_all('div', attrs={
-                    'data-qa': 'vacancy-serp__vacancy'
-                })
-                premium_vacancies_divs = result.find_all('div', attrs={
-                    'data-qa': 'vacancy-serp__vacancy vacancy-serp__vacancy_premium'
-                })
-                vacancies_data = self._get_data_from_divs(vacancies_divs)
-                premium_vacancies_data = self._get_data_from_divs(premium_vacancies_divs)
-                raw_vacancies_data += vacancies_data + premium_vacancies_data
-            else:
-                log.error(f'Request failed')
-                raise RuntimeError('Request failed')
-            url_counter += 1
+        vacancies_pages_params = list(self._get_pages_params())
+
+        # Данные собираем по столбцам: датафрейм из списков строится без разбора каждой записи
+        raw_vacancies_data = {'date': [], 'title': [], 'salary': [], 'company': [], 'href': []}
+        # Каждый поток и запрашивает, и разбирает свою страницу: разбор одних страниц идет, пока другие загружаются
+        with ThreadPoolExecutor(max_workers=min(_MAX_FETCH_WORKERS, len(vacancies_pages_params))) as executor:
+            pages_data = executor.map(self._fetch_and_parse_page, vacancies_pages_params)
+            for url_counter, page_data in enumerate(pages_data, start=1):
+                if page_data is None:
+                    log.error(f'Request failed')
+                    raise RuntimeError('Request failed')
+                log.info(f'Page {url_counter} parsed')
+                for column, values in page_data.items():
+                    raw_vacancies_data[column].extend(values)
 
         df = pd.DataFrame(raw_vacancies_data)
         if len(df) == 0:
             log.error(f'No results found for settings: area={self.__area}, period={self.__search_period}, '
                       f'text={self.__search_text}, specifying_regex={self.__search_regex}')
             raise RuntimeError('No results found')
-        df['date'] = pd.to_datetime(df['date'], dayfirst=True)
-        df = df[['date', 'title', 'salary', 'company', 'href']].sort_values(by='date', ascending=False)
+        df['date'] = self._process_dates(df['date'])
+        df = df.sort_values(by='date', ascending=False)
 
         parse_duration = round(time.monotonic() - time_start, 2)
         log.info(f'Found {len(df)} vacancies in {parse_duration} seconds')
@@ -143,91 +163,82 @@ class HhParser:
         results.search_regex = self.__search_regex
         return results
 
+    def _fetch_and_parse_page(self, params: dict) -> Optional[Dict[str, List[str]]]:
+        """
+        Запроси страницу с вакансиями и получи из нее данные вакансий.
+        :param params: Параметры запроса страницы
+        :return: Данные вакансий по столбцам или None при ошибке запроса
+        """
+        response = self.__request_page(self.__base_url, params)
+        if response is False:
+            return
+        # Обычные и премиальные вакансии отбираются одним проходом
+        vacancies_divs = _XP_VACANCY(lxml.html.fromstring(response.text))
+        return self._get_data_from_divs(vacancies_divs)
+
     def _vacancy_name_check(self, title: str) -> bool:
         """
         Проверь название вакансии уточняющим регулярным выражением.
         :param title: Название вакансии
         """
-        if re.search(self.__search_regex, title, flags=re.IGNORECASE):
-            return True
-        return False
+        return self.__search_regex_compiled.search(title) is not None
 
     @staticmethod
-    def _process_date(raw_date: str) -> str:
+    def _process_dates(raw_dates: pd.Series) -> pd.Series:
         """
-        Преобразуй дату публикации вакансии.
-        :param raw_date: Дата из вакансии
+        Преобразуй даты публикации вакансий.
+        :param raw_dates: Даты из вакансий, например: "5 мая"
         """
-        date_dict = {
-            'января': '01',
-            'февраля': '02',
-            'марта': '03',
-            'апреля': '04',
-            'мая': '05',
-            'июня': '06',
-            'июля': '07',
-            'августа': '08',
-            'сентября': '09',
-            'октября': '10',
-            'ноября': '11',
-            'декабря': '12'
-        }
-        date_arr = raw_date.split(' ')
-        for i in range(len(date_arr)):
-            try:
-                date_arr[i] = date_dict[date_arr[i]]
-            except KeyError:
-                pass
-
+        now = datetime.datetime.now()
+        dates = raw_dates.str.replace(_MONTHS_RE, lambda m: _MONTHS[m.group(0)], regex=True)
         # Добавляем год к дате
-        date_arr.append(str(datetime.datetime.now().year))
-        if datetime.datetime.strptime('.'.join(date_arr), '%d.%m.%Y') > datetime.datetime.now():
-            date_arr[-1] = str(datetime.datetime.now().year - 1)
-
-        return '.'.join(date_arr)
+        dates = pd.to_datetime(dates.str.replace(' ', '.', regex=False) + f'.{now.year}', format='%d.%m.%Y')
+        # Дата из будущего означает, что вакансия опубликована в прошлом году
+        return dates.where(dates <= now, dates - pd.DateOffset(years=1))
 
-    def _get_data_from_divs(self, divs: List) -> List[dict]:
+    def _get_data_from_divs(self, divs: List[lxml.html.HtmlElement]) -> Dict[str, List[str]]:
         """
         Получи данные из блоков с вакансиями.
         :param divs: Блоки с вакансиями
+        :return: Списки значений по столбцам
         """
-        results = []
+        results = {'date': [], 'title': [], 'salary': [], 'company': [], 'href': []}
         for div in divs:
-            title = div.find('a', attrs={'data-qa': 'vacancy-serp__vacancy-title'}).text
+            title_data = _XP_TITLE(div)[0]
+            title = title_data.text_content()
             if not self._vacancy_name_check(title):
                 continue
 
-            company_data = div.find('a', attrs={'data-qa': 'vacancy-serp__vacancy-employer'})
-            company = company_data.text if company_data else 'Не определено'
-            href = div.find('a', attrs={'data-qa': 'vacancy-serp__vacancy-title'}).get('href')
-            date = self._process_date(
-                div.find('span', attrs={'class': 'vacancy-serp-item__publication-date'}).text.replace('\xa0', ' ')
-            )
-            salary_data = div.find('span', attrs={'data-qa': 'vacancy-serp__vacancy-compensation'})
-            salary = salary_data.text.replace('\xa0', '') if salary_data else 'Не указано'
+            company_data = _XP_EMPLOYER(div)
+            company = company_data[0].text_content() if company_data else 'Не определено'
+            href = title_data.get('href')
+            date = _XP_DATE(div)[0].text_content().replace('\xa0', ' ')
+            salary_data = _XP_SALARY(div)
+            salary = salary_data[0].text_content().replace('\xa0', '') if salary_data else 'Не указано'
 
-            results.append({'title': title, 'company': company, 'salary': salary, 'date': date, 'href': href})
+            results['date'].append(date)
+            results['title'].append(title)
+            results['salary'].append(salary)
+            results['company'].append(company)
+            results['href'].append(href)
 
         return results
 
-    def __exponential_backoff(self, url: str) -> Union[requests.Response, bool]:
+    def __request_page(self, url: str, params: dict) -> Union[requests.Response, bool]:
         """
-        Экспоненциальная выдержка для 403, 500 и 503 ошибки.
+        Запроси страницу. Повторы с экспоненциальной выдержкой для 403, 500 и 503 ошибки выполняет адаптер сессии.
         :param url: URL запроса
+        :param params: Параметры запроса, requests сам добавит их к URL с нужным кодированием
         :return: Ответ сервера или False при ошибке
         """
-        for n in range(0, 5):
-            log.debug(f'GET request to URL {url}')
-            response = self.__session.get(url, headers=self.__headers)
-            if response.status_code in [403, 500, 503]:
-                log.debug(f'HTTP error: {response.status_code}. Trying again. Attempt {n + 1}')
-                time.sleep((2 ** n) + random.random())
-            elif response.status_code == 200:
-                return response
-            else:
-                log.error(f'HTTP error {response.status_code} during requesting URL: {url}')
-                return False
-        log.error(f'Failed request URL {url} in 5 attempts')
+        log.debug(f'GET request to URL {url} with params {params}')
+        with _HH_REQUESTS_SEMAPHORE:
+            response = self.__session.get(url, params=params)
+        if response.status_code == 200:
+            # hh.ru отдает страницы в UTF-8: кодировку задаем явно, чтобы не определять ее по содержимому
+            response.encoding = 'utf-8'
+            return response
+        log.error(f'HTTP error {response.status_code} during requesting URL: {response.url}')
         return False
 
 
@@ -243,6 +254,7 @@ class HhParserResultsProcessor:
         self.__df = hh_parsed_data.data
         self.__parsing_duration = hh_parsed_data.parse_duration
         self.__pg_conn = pg_conn
+        self.__salaries = None
 
     hh_parsed_data = property(lambda self: self.__hh_parsed_data)
     report_folder = property(lambda self: self.__report_folder)
@@ -257,40 +269,38 @@ class HhParserResultsProcessor:
 
     def _find_jobs_without_salary(self) -> Dict[str, Union[int, float]]:
         """Найди % вакансий без указания зарплаты."""
-        unknown_salary_count = self.__df.loc[self.__df['salary'] == 'Не указано']['salary'].count()
+        unknown_salary_count = (self.__df['salary'] == 'Не указано').sum()
         unknown_salary_percent = round((unknown_salary_count / len(self.__df)) * 100, 2)
         log.info(f'Jobs without salary: {unknown_salary_percent}%')
         return {'jobs_without_salary': unknown_salary_percent}
 
+    def _get_salaries(self) -> pd.DataFrame:
+        """
+        Разбери зарплаты вакансий одним векторным проходом.
+        :return: Датафрейм с индексом исходных данных и колонками: 'prefix' - "от", "до" или NaN,
+            'low' - первое число зарплаты, 'high' - второе число вилки (NaN, если вилки нет)
+        """
+        if self.__salaries is None:
+            salaries = self.__df['salary'].str.extract(_SALARY_RE)
+            salaries.columns = ['prefix', 'low', 'high']
+            salaries['low'] = pd.to_numeric(salaries['low'])
+            salaries['high'] = pd.to_numeric(salaries['high'])
+            self.__salaries = salaries
+        return self.__salaries
+
     def _find_salary_mean_and_median(self) -> Dict[str, Union[int, float]]:
         """Найди медианную, среднюю, среднюю максимальную и средней минимальную зарплаты."""
-        salaries_min = []
-        salaries_max = []
-        for i in range(len(self.__df)):
-            # Указана зарплата "от"
-            if self.__df.loc[i, 'salary'].split()[0] == 'от':
-                salaries_min.append(int(self.__df.loc[i, 'salary'].split()[1]))
-            # Указана зарплата "до"
-            elif self.__df.loc[i, 'salary'].split()[0] == 'до':
-                salaries_max.append(int(self.__df.loc[i, 'salary'].split()[1]))
-            # Указана вилка зарплаты
-            elif len(self.__df.loc[i, 'salary'].split()[0].split('-')) == 2:
-                fork = self.__df.loc[i, 'salary'].split()[0].split('-')
-                salaries_min.append(int(fork[0]))
-                salaries_max.append(int(fork[1]))
-            # Зарплата не указана
-            elif self.__df.loc[i, 'salary'] == 'Не указано':
-                pass
-            # Указана фиксированная зарплата
-            else:
-                salaries_min.append(int(self.__df.loc[i, 'salary'].split()[0]))
-                salaries_max.append(int(self.__df.loc[i, 'salary'].split()[0]))
-
-        salaries_all = salaries_min + salaries_max
-        salary_mean = round(pd.Series(salaries_all).mean())
-        salary_median = round(pd.Series(salaries_all).median())
-        min_salary_mean = round(pd.Series(salaries_min).mean())
-        max_salary_mean = round(pd.Series(salaries_max).mean())
+        salaries = self._get_salaries()
+        # Нижняя граница есть у зарплат "от", вилок и фиксированных, верхняя - у зарплат "до", вилок и фиксированных.
+        # Строки без зарплаты ("Не указано") дают NaN и отбрасываются
+        salaries_min = salaries['low'].where(salaries['prefix'] != 'до').dropna()
+        salaries_max = salaries['high'].fillna(salaries['low']).where(salaries['prefix'] != 'от').dropna()
+
+        salaries_all = pd.concat([salaries_min, salaries_max])
+        salary_mean = round(salaries_all.mean())
+        salary_median = round(salaries_all.median())
+        min_salary_mean = round(salaries_min.mean())
+        max_salary_mean = round(salaries_max.mean())
         log.info(f'Mean salary: {salary_mean}, median salary: {salary_median}, mean min salary: {min_salary_mean}, '
                  f'mean max salary: {max_salary_mean}')
         return {'salary_mean': salary_mean,
@@ -304,112 +314,55 @@ class HhParserResultsProcessor:
         data_for_update.update(self._find_jobs_without_salary())
         data_for_update.update(self._find_salary_mean_and_median())
         data_for_update.update({'jobs_count': len(self.__df),
-                                'date': datetime.datetime.now().strftime("%Y-%m-%d"),
+                                'date': pd.Timestamp.now().normalize(),
                                 'time_parse': self.__parsing_duration})
         df = pd.DataFrame([data_for_update])
-        df['date'] = pd.to_datetime(df['date'])
         self.__hh_parsed_data.df_parsing_results = df
         log.info(f'DataFrame for "parsing_results" table generated')
 
     def _get_current_jobs_df(self) -> None:
         """Сформируй датафрейм для таблицы "current_jobs"."""
-        min_salary = []
-        max_salary = []
+        salaries = self._get_salaries()
         df = self.__df.copy().reset_index(drop=True)
-        for i in range(len(df)):
-            # Указана зарплата "от"
-            if df.loc[i, 'salary'].split()[0] == 'от':
-                min_salary.append(int(df.loc[i, 'salary'].split()[1]))
-                max_salary.append(int(df.loc[i, 'salary'].split()[1]))
-            # Укащана зарплата "до"
-            elif df.loc[i, 'salary'].split()[0] == 'до':
-                min_salary.append(0)
-                max_salary.append(int(df.loc[i, 'salary'].split()[1]))
-            # Указана вилка зарплаты
-            elif len(df.loc[i, 'salary'].split()[0].split('-')) == 2:
-                fork = df.loc[i, 'salary'].split()[0].split('-')
-                min_salary.append(int(fork[0]))
-                max_salary.append(int(fork[1]))
-            # Зарплата не указана
-            elif df.loc[i, 'salary'] == 'Не указано':
-                min_salary.append(0)
-                max_salary.append(0)
-            # Указана фиксированная зарплата
-            else:
-                min_salary.append(int(df.loc[i, 'salary'].split()[0]))
-                max_salary.append(int(df.loc[i, 'salary'].split()[0]))
-
-        df['min_salary'] = min_salary
-        df['max_salary'] = max_salary
+        # Для зарплаты "от" максимум равен минимуму, для зарплаты "до" минимум равен 0, без зарплаты - оба равны 0
+        df['min_salary'] = salaries['low'].mask(salaries['prefix'] == 'до', 0).fillna(0).astype(int).to_numpy()
+        df['max_salary'] = salaries['high'].fillna(salaries['low']).fillna(0).astype(int).to_numpy()
         df['mean_salary'] = (df['min_salary'] + df['max_salary']) / 2
         df = df.sort_values(['mean_salary', 'max_salary', 'min_salary'], ascending=False).reset_index(drop=True)
         df['row'] = list(range(1, len(df) + 1))
         self.__hh_parsed_data.df_current_jobs = df[['row', 'date', 'title', 'company', 'salary', 'href']]
         log.info(f'DataFrame for "current_jobs" table generated')
 
-    def _get_unique_jobs_merged_df(self) -> pd.DataFrame:
-        """Получи сджойненый датафрейм уникальных вакансий из Postgres и результатов парсинга."""
-        pg_unique_jobs_raw = self.__pg_conn.get_table(table_name='unique_jobs')
-        pg_unique_jobs = self._get_df_from_pgtable(pg_unique_jobs_raw)
-        if pg_unique_jobs is None or pg_unique_jobs.empty:
-            pg_unique_jobs = pd.DataFrame.from_dict({'date': [], 'href': []})
-            pg_unique_jobs['date'] = pd.to_datetime(pg_unique_jobs['date'])
-            pg_unique_jobs['href'] = pg_unique_jobs['href'].astype(str)
-        r = pd.merge(pg_unique_jobs, self.__df[['date', 'href']], on='href', how='outer')
-        return r
-
-    @staticmethod
-    def _get_df_from_pgtable(pg_table: ConnPostgreSQL.PgTable) -> Union[pd.DataFrame, None]:
-        """
-        Получи датафрейм из PgTable.
-        :param pg_table: Таблица Postgres
-        :return: Датафрейм, если есть данные, в противном случае - None
-        """
-        if not pg_table:
-            return
-        df_from_pg = pd.DataFrame()
-        for df in pg_table.table_data:
-            df_from_pg = df_from_pg.append(df)
-        return df_from_pg
-
     def _get_unique_jobs_df(self) -> None:
         """Сформируй датафрейм для таблицы "unique_jobs"."""
-        df_merged = self._get_unique_jobs_merged_df()
-        df_merged = df_merged[pd.isnull(df_merged['date_x'])][['date_y', 'href']].reset_index(drop=True)
-        df_merged.columns = ['date', 'href']
-        self.__hh_parsed_data.df_unique_jobs = df_merged
+        new_hrefs = self.__df['href']
+        if self.__pg_conn.table_exists('public.unique_jobs'):
+            # Новые вакансии отбирает Postgres: таблица уникальных вакансий по сети не передается
+            query = 'SELECT r.href FROM unnest(%s::text[]) AS r(href) ' \
+                    'WHERE NOT EXISTS (SELECT 1 FROM public.unique_jobs u WHERE u.href = r.href)'
+            with self.__pg_conn.run_sql_query(query, (self.__df['href'].tolist(),)) as cur:
+                new_hrefs = [href for href, in cur.fetchall()]
+        df = self.__df[self.__df['href'].isin(new_hrefs)][['date', 'href']].reset_index(drop=True)
+        self.__hh_parsed_data.df_unique_jobs = df
         log.info(f'DataFrame for "unique_jobs" table generated')
 
     def _get_unique_closed_jobs_df(self) -> None:
         """Сформируй датафрейм для таблицы "unique_closed_jobs"."""
-        df_merged = self._get_unique_jobs_merged_df()
-        df_merged = df_merged[pd.isnull(df_merged['date_y'])].reset_index(drop=True)
-        df_merged.columns = ['publication_date', 'href', 'closing_date']
-        df_merged['closing_date'] = datetime.datetime.now().strftime("%Y-%m-%d")
-        df_merged['href'] = df_merged['href'].astype(str)
-        df_merged['closing_date'] = pd.to_datetime(df_merged['closing_date'])
-        df_merged['publication_date'] = pd.to_datetime(df_merged['publication_date'])
-        df_merged['date_diff'] = (df_merged['closing_date'] - df_merged['publication_date']).dt.days.astype(int)
-
-        pg_unique_closed_jobs_raw = self.__pg_conn.get_table(table_name='unique_closed_jobs')
-        pg_unique_closed_jobs = self._get_df_from_pgtable(pg_unique_closed_jobs_raw)
-        if pg_unique_closed_jobs is None or pg_unique_closed_jobs.empty:
-            pg_unique_closed_jobs = pd.DataFrame().from_dict({
-                'href': [],
-                'publication_date': [],
-                'closing_date': [],
-                'date_diff': []
-            })
-            pg_unique_closed_jobs['closing_date'] = pd.to_datetime(pg_unique_closed_jobs['closing_date'])
-            pg_unique_closed_jobs['publication_date'] = pd.to_datetime(pg_unique_closed_jobs['publication_date'])
-            pg_unique_closed_jobs['date_diff'] = pg_unique_closed_jobs['date_diff'].astype(int)
-            pg_unique_closed_jobs['href'] = pg_unique_closed_jobs['href'].astype(str)
-
-        df_merged_closed_jobs = pd.merge(pg_unique_closed_jobs, df_merged, on='href', how='outer')
-        df_merged_closed_jobs = df_merged_closed_jobs[pd.isnull(df_merged_closed_jobs['closing_date_x'])]
-        df_merged_closed_jobs = df_merged_closed_jobs[['href', 'publication_date_y', 'closing_date_y', 'date_diff_y']]\
-            .reset_index(drop=True)
-        df_merged_closed_jobs.columns = ['href', 'publication_date', 'closing_date', 'date_diff']
-        df_merged_closed_jobs['date_diff'] = df_merged_closed_jobs['date_diff'].astype(int)
-        self.__hh_parsed_data.df_unique_closed_jobs = df_merged_closed_jobs
+        closed_jobs = []
+        if self.__pg_conn.table_exists('public.unique_jobs'):
+            # Закрытые вакансии - известные вакансии, которых нет в результатах парсинга
+            # и которые еще не записаны в таблицу закрытых вакансий
+            query = 'SELECT u.href, u.date FROM public.unique_jobs u ' \
+                    'WHERE NOT EXISTS (SELECT 1 FROM unnest(%s::text[]) AS r(href) WHERE r.href = u.href)'
+            if self.__pg_conn.table_exists('public.unique_closed_jobs'):
+                query += ' AND NOT EXISTS (SELECT 1 FROM public.unique_closed_jobs c WHERE c.href = u.href)'
+            with self.__pg_conn.run_sql_query(query, (self.__df['href'].tolist(),)) as cur:
+                closed_jobs = cur.fetchall()
+
+        df = pd.DataFrame(closed_jobs, columns=['href', 'publication_date'])
+        df['href'] = df['href'].astype(str)
+        df['publication_date'] = pd.to_datetime(df['publication_date'])
+        df['closing_date'] = pd.Series(pd.Timestamp.now().normalize(), index=df.index, dtype='datetime64[ns]')
+        df['date_diff'] = (df['closing_date'] - df['publication_date']).dt.days.astype(int)
+        self.__hh_parsed_data.df_unique_closed_jobs = df
         log.info(f'DataFrame for "unique_closed_jobs" table generated')
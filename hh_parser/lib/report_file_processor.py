@@ -2,8 +2,10 @@ import logging
 import os
 from datetime import datetime
 
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
 from openpyxl.utils import get_column_letter
 
 from .parser import HhParser
@@ -16,7 +18,12 @@ class ReportFileProcessor:
 
     def __init__(self, hh_parsed_data: HhParser.HhParserResults) -> None:
         self.__report_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'temp')
-        self.__formats = {'background_col_name': PatternFill('solid', fgColor='D6DCE3')}
+        thin_side = Side(style='thin')
+        # Оформление заголовков как у pandas.DataFrame.to_excel, плюс заливка фона
+        self.__formats = {'background_col_name': PatternFill('solid', fgColor='D6DCE3'),
+                          'font_col_name': Font(bold=True),
+                          'border_col_name': Border(left=thin_side, right=thin_side, top=thin_side, bottom=thin_side),
+                          'alignment_col_name': Alignment(horizontal='center', vertical='top')}
         self.__parsing_results = hh_parsed_data.df_current_jobs
         self.__search_text = hh_parsed_data.search_text
 
@@ -32,28 +39,44 @@ class ReportFileProcessor:
         :return: Путь к созданному файлу
         """
         file_path = os.path.join(self.__report_folder, self._get_report_file_name())
-        self.__parsing_results.to_excel(file_path, index=False)
-        self._format_file(file_path)
+        self._write_file(file_path)
         log.info(f'Report file created: {file_path}')
         return file_path
 
-    def _format_file(self, file_path: str) -> None:
+    def _write_file(self, file_path: str) -> None:
         """
-        "Причеши" файл с результатами парсинга.
+        Запиши оформленный файл с результатами парсинга за один проход.
         :param file_path: Путь к файлу
         """
-        wb = load_workbook(filename=file_path)
-        ws = wb['Sheet1']
+        df = self.__parsing_results
+        # Пропуски pandas записываем пустыми ячейками
+        rows = list(df.astype(object).where(pd.notnull(df), None).itertuples(index=False, name=None))
 
-        for col in range(ws.max_column):
-            # Выделяем фон ячеек с названием столбцов
-            for cell in list(ws.columns)[col]:
-                if cell.row == 1:
-                    cell.fill = self.__formats['background_col_name']
+        # Ширина столбца - длина самого длинного значения, включая название столбца
+        widths = [max(len(str(col)), int(df[col].map(str).str.len().max()) if len(df) else 0) for col in df.columns]
 
-            # Выставляем ширину столбцов
-            length = max([len(str(cell.value)) for cell in list(ws.columns)[col]])
-            ws.column_dimensions[get_column_letter(col + 1)].width = length
+        # В режиме write_only книга не держится в памяти целиком, а ширину столбцов задаем до записи строк
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Sheet1')
+        for col, width in enumerate(widths, start=1):
+            ws.column_dimensions[get_column_letter(col)].width = width
+
+        ws.append([self._get_header_cell(ws, col) for col in df.columns])
+        for row in rows:
+            ws.append(row)
 
         wb.save(filename=file_path)
         log.debug('Report file formatted')
+
+    def _get_header_cell(self, ws, value: str) -> WriteOnlyCell:
+        """
+        Получи оформленную ячейку с названием столбца.
+        :param ws: Лист книги
+        :param value: Название столбца
+        """
+        cell = WriteOnlyCell(ws, value=value)
+        cell.fill = self.__formats['background_col_name']
+        cell.font = self.__formats['font_col_name']
+        cell.border = self.__formats['border_col_name']
+        cell.alignment = self.__formats['alignment_col_name']
+        return cell
@@ -1,11 +1,12 @@
 import logging
+import logging.handlers
 import os
 import sys
 import traceback
 from collections import namedtuple
-from datetime import datetime
-from functools import wraps
-from typing import Any, Union, Optional, List, Tuple, Callable
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
+from typing import Any, Union, Optional, List, Sequence, Tuple, Callable
 
 import yaml
 
@@ -13,10 +14,36 @@ from .conn_email_server import ConnSmtpEmailServer
 
 log = logging.getLogger(__name__)
 
+# C-реализация загрузчика (LibYAML), если PyYAML собран с ней
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# Уровни логирования для set_logging
+_LOG_LEVELS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+}
+# Формат записей лога, общий для всех обработчиков
+_LOG_FORMATTER = logging.Formatter('%(asctime)s %(levelname)s [%(process)d-%(threadName)s] [%(filename)s '
+                                   '%(funcName)s row:%(lineno)d] %(message)s')
+# Количество записей лога, накапливаемых перед записью в файл
+_LOG_FILE_BUFFER_CAPACITY = 256
+
+_LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+_ROOT_DIR = os.path.dirname(_LIB_DIR)
+# Папки для поиска файлов креденшиалс в порядке приоритета
+_CREDS_SEARCH_FOLDERS = (
+    os.path.join(_ROOT_DIR, 'credentials'),
+    _ROOT_DIR,
+    _LIB_DIR,
+    os.path.join(_LIB_DIR, 'credentials'),
+)
+
 
 def exception_notify(smtp_host: str, smtp_login: str, smtp_password: str, email_to: Union[str, List[str]],
                      email_from: str, smtp_port: int = 465, smtp_use_ssl: bool = True,
-                     log_file_path: Optional[str] = None) -> Callable:
+                     log_file_path: Optional[str] = None, pending_notifications: Optional[list] = None) -> Callable:
     """
     Декоратор. Залогируй ошибку и отправь оповещение на email.
     :param smtp_host: Хост smtp-сервера
@@ -27,6 +54,8 @@ def exception_notify(smtp_host: str, smtp_login: str, smtp_password: str, email_
     :param email_to: Email получателя (получателей)
     :param email_from: Email отправителя
     :param log_file_path: Путь к файлу с логами
+    :param pending_notifications: Очередь оповещений. Если передана, оповещение не отправляется сразу, а ставится
+        в очередь для send_pending_notifications
     """
     def wrapper(func):
         @wraps(func)
@@ -34,47 +63,113 @@ def exception_notify(smtp_host: str, smtp_login: str, smtp_password: str, email_
             try:
                 return func(*args, **kwargs)
             except Exception as e:
-                log.error(e, exc_info=True)
-                smtp_conn = ConnSmtpEmailServer(host=smtp_host, port=smtp_port, login=smtp_login,
-                                                password=smtp_password, use_ssl=smtp_use_ssl)
-                smtp_conn.send_email(
-                    email_from=email_from,
-                    email_to=email_to,
-                    subject='EXCEPTION OCCURRED',
-                    text=f'{datetime.now().strftime("%d.%m.%Y %H:%M:%S")}\n\n{traceback.format_exc()}',
-                    attachments=log_file_path
-                )
-                smtp_conn.disconnect()
+                # Трейсбек форматируем один раз: он нужен и в логе, и в тексте оповещения
+                error_traceback = traceback.format_exc()
+                log.error(f'{e}\n{error_traceback.rstrip()}')
+                smtp_params = (smtp_host, smtp_port, smtp_login, smtp_password, smtp_use_ssl)
+                notification = {
+                    'email_from': email_from,
+                    'email_to': email_to,
+                    'subject': 'EXCEPTION OCCURRED',
+                    'text': f'{datetime.now().strftime("%d.%m.%Y %H:%M:%S")}\n\n{error_traceback}',
+                    'attachments': log_file_path,
+                }
+                if pending_notifications is not None:
+                    pending_notifications.append((smtp_params, notification))
+                else:
+                    send_pending_notifications([(smtp_params, notification)])
                 raise e
         return log_error_and_notify
     return wrapper
 
 
+def send_pending_notifications(pending_notifications: List[Tuple[tuple, dict]]) -> None:
+    """
+    Отправь накопленные оповещения: по одной SMTP-сессии на каждый smtp-сервер.
+    :param pending_notifications: Очередь оповещений из exception_notify
+    """
+    notifications_by_server = {}
+    for smtp_params, notification in pending_notifications:
+        notifications_by_server.setdefault(smtp_params, []).append(notification)
+    pending_notifications.clear()
+    if not notifications_by_server:
+        return
+
+    # Буферизованные записи лога сбрасываем в файл до того, как он будет приложен к письмам
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+    for (host, port, login, password, use_ssl), notifications in notifications_by_server.items():
+        with ConnSmtpEmailServer(host=host, port=port, login=login, password=password, use_ssl=use_ssl) as smtp_conn:
+            smtp_conn.send_emails([smtp_conn.create_email(**n) for n in notifications])
+
+
 def read_yml_config(file_path: str) -> namedtuple:
     """
     Прочитай yml-файл конфигурации.
+    Повторное чтение неизмененного файла берется из кэша.
     :param file_path: Путь к файлу конфигурации
     """
-    with open(file_path) as file:
-        config_raw = yaml.safe_load(file)
-
-    def to_namedtuple(value: Any, key: Any = 'obj') -> namedtuple:
-        """Приведи конфиг в namedtuple."""
-        if type(value) is dict:
-            for k in value.keys():
-                value[k] = to_namedtuple(value.get(k), k)
-            return namedtuple(key, value.keys())(**value)
-        if type(value) is list:
-            for i, item in enumerate(value):
-                value[i] = to_namedtuple(item, key)
-            return value
-        return value
-
-    config = to_namedtuple(config_raw, 'config')
-    log.debug(f'Config: {config}')
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    return _read_yml_config_cached(file_path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=64)
+def _read_yml_config_cached(file_path: str, mtime_ns: int, size: int) -> namedtuple:
+    """
+    Прочитай yml-файл конфигурации.
+    :param file_path: Абсолютный путь к файлу конфигурации
+    :param mtime_ns: Время изменения файла в наносекундах, часть ключа кэша
+    :param size: Размер файла, часть ключа кэша
+    """
+    # Файл читаем в байтах: декодирование выполняет сам LibYAML
+    with open(file_path, 'rb') as file:
+        config_raw = yaml.load(file, Loader=_YamlLoader)
+
+    config = _to_namedtuple(config_raw, 'config')
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f'Config: {config}')
     return config
 
 
+@lru_cache(maxsize=None)
+def _get_namedtuple_class(typename: str, field_names: Tuple[str, ...]) -> type:
+    """
+    Получи класс namedtuple. Классы с одинаковыми названием и полями создаются один раз.
+    :param typename: Название класса
+    :param field_names: Названия полей
+    """
+    return namedtuple(typename, field_names)
+
+
+def _to_namedtuple(value: Any, key: str = 'obj') -> Any:
+    """
+    Приведи конфиг в namedtuple. Исходные данные не изменяются.
+    :param value: Распарсенный конфиг
+    :param key: Название класса для корневого словаря
+    """
+    # Обход в глубину с явным стеком, затем сборка узлов в обратном порядке: потомки готовы раньше родителей
+    nodes = []
+    stack = [(value, key)]
+    while stack:
+        node, node_key = stack.pop()
+        nodes.append((node, node_key))
+        if isinstance(node, dict):
+            stack.extend((v, k) for k, v in node.items())
+        elif isinstance(node, list):
+            stack.extend((item, node_key) for item in node)
+
+    converted = {}
+    for node, node_key in reversed(nodes):
+        if isinstance(node, dict):
+            cls = _get_namedtuple_class(node_key, tuple(node))
+            converted[id(node)] = cls(*(converted.get(id(v), v) for v in node.values()))
+        elif isinstance(node, list):
+            converted[id(node)] = [converted.get(id(item), item) for item in node]
+    return converted.get(id(value), value)
+
+
 def set_logging(level: str = 'INFO', log_to_stream: bool = True, log_to_file: bool = True,
                 logs_folder: str = os.path.abspath(os.path.dirname(__file__))) -> Optional[str]:
     """
@@ -86,19 +181,18 @@ def set_logging(level: str = 'INFO', log_to_stream: bool = True, log_to_file: bo
     :return: Путь к log-файлу, если включена запись логов в файл
     """
     root_logger = logging.getLogger()
-    log_levels = {
-        'DEBUG': logging.DEBUG,
-        'INFO': logging.INFO,
-        'WARNING': logging.WARNING,
-        'ERROR': logging.ERROR,
-        'CRITICAL': logging.CRITICAL,
-    }
-    root_logger.setLevel(log_levels.get(level))
-    formatter = logging.Formatter('%(asctime)s %(levelname)s [%(process)d-%(threadName)s] [%(filename)s '
-                                  '%(funcName)s row:%(lineno)d] %(message)s')
+    root_logger.setLevel(_LOG_LEVELS.get(level))
+    # Повторный вызов заменяет обработчики, добавленные ранее, а не дублирует их
+    for handler in root_logger.handlers[:]:
+        target = getattr(handler, 'target', None) or handler
+        if target.formatter is _LOG_FORMATTER:
+            root_logger.removeHandler(handler)
+            handler.close()
+            if target is not handler:
+                target.close()
     if log_to_stream:
         sh = logging.StreamHandler(stream=sys.stdout)
-        sh.setFormatter(formatter)
+        sh.setFormatter(_LOG_FORMATTER)
         root_logger.addHandler(sh)
     if log_to_file:
         if not os.path.exists(logs_folder):
@@ -108,52 +202,60 @@ def set_logging(level: str = 'INFO', log_to_stream: bool = True, log_to_file: bo
         log_file_name = f'{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.log'
         log_file_path = os.path.join(logs_folder, log_file_name)
         fh = logging.FileHandler(log_file_path, encoding='utf-8')
-        fh.setFormatter(formatter)
-        root_logger.addHandler(fh)
+        fh.setFormatter(_LOG_FORMATTER)
+        # Записи пишутся в файл пачками; ошибки сбрасывают буфер сразу, остаток - logging.shutdown при выходе
+        mh = logging.handlers.MemoryHandler(capacity=_LOG_FILE_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=fh)
+        root_logger.addHandler(mh)
         return log_file_path
 
 
-def remove_old_files(folder_path: str, lifetime_days: int, file_type: Union[str, Tuple[str, ...]]) -> None:
+def remove_old_files(folder_path: str, lifetime_days: int, file_type: Union[str, Sequence[str]]) -> None:
     """
     Удали "старые" файлы.
     :param folder_path: Путь к директории, в которой нужно удалить "старые" файлы
     :param lifetime_days: Количество дней, после которых файл становится "старым"
     :param file_type: Расширения файлов, которые необходимо удалить, например: .csv
     """
-    raw_files = []
-    for path, dirs, files in [i for i in os.walk(folder_path)]:
-        for file in files:
-            raw_files.append(os.path.join(path, file))
-    files_with_expansions = list(filter(lambda x: x.endswith(file_type), raw_files))
-
+    # str.endswith принимает только строку или кортеж: списки расширений приводим к кортежу
+    extensions = file_type if isinstance(file_type, str) else tuple(file_type)
+    # Файл "старый", если создан раньше полуночи дня, отстоящего от сегодняшнего на lifetime_days - 1 дней
+    cutoff = (datetime.combine(date.today(), datetime.min.time()) - timedelta(days=lifetime_days - 1)).timestamp()
     removed_files = []
-    date_today = datetime.now().date()
-    for file in files_with_expansions:
-        file_date = datetime.fromtimestamp(os.path.getctime(file)).date()
-        if abs((date_today - file_date).days) >= lifetime_days:
-            os.remove(file)
-            removed_files.append(os.path.basename(file))
+    # Один проход по дереву: os.scandir отдает метаданные вместе с записями папки, os.walk не нужен
+    folders = [folder_path]
+    while folders:
+        try:
+            entries = os.scandir(folders.pop())
+        except OSError:
+            # Как и os.walk, пропускаем недоступные папки
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # Как и os.walk, не переходим по символическим ссылкам на папки
+                    if not entry.is_symlink():
+                        folders.append(entry.path)
+                elif entry.name.endswith(extensions) and entry.stat().st_ctime < cutoff:
+                    os.remove(entry.path)
+                    removed_files.append(entry.name)
 
+    files_mask = ', '.join(f'*{ext}' for ext in ((extensions,) if isinstance(extensions, str) else extensions))
     if not removed_files:
-        log.debug(f'Old (over {lifetime_days} days) *{file_type} files not found in {folder_path}')
-    else:
-        log.info(f'Removed {len(removed_files)} old (over {lifetime_days} days) *{file_type} files '
+        log.debug(f'Old (over {lifetime_days} days) {files_mask} files not found in {folder_path}')
+    # Список удаленных файлов может быть длинным: сообщение формируем, только если оно попадет в лог
+    elif log.isEnabledFor(logging.INFO):
+        log.info(f'Removed {len(removed_files)} old (over {lifetime_days} days) {files_mask} files '
                  f'from {folder_path}: {removed_files}')
 
 
+@lru_cache(maxsize=None)
 def get_creds_file_path(file_name: str) -> str:
     """
-    Найди файл креденшиалс в проекте.
+    Найди файл креденшиалс в проекте. Найденный путь кэшируется.
     :param file_name: Имя файла
     :return: Путь к файлу
     """
-    search_folders = [
-        os.path.join(os.path.abspath(os.path.dirname(os.path.dirname(__file__))), 'credentials'),
-        os.path.abspath(os.path.dirname(os.path.dirname(__file__))),
-        os.path.abspath(os.path.dirname(__file__)),
-        os.path.join(os.path.abspath(os.path.dirname(__file__)), 'credentials'),
-    ]
-    for folder in search_folders:
+    for folder in _CREDS_SEARCH_FOLDERS:
         log.debug(f'Searching for creds file in {folder}...')
         file_path = os.path.join(folder, file_name)
         if os.path.isfile(file_path):